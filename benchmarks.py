@@ -0,0 +1,319 @@
+import argparse
+import io
+import json
+import platform
+import random
+import statistics
+import sys
+import time
+
+from parse_midi import (EventStore, Song, create_columnar_song, get_chord_library, match_chord_vector,
+                        parse_header, parse_midi_data, parse_track, parse_midi_file)
+from write_midi import encode_song, encode_variable_time
+
+SAMPLE_FILES = ['snowman.mid', 'world-1-birabuto.mid']
+
+
+def parse_with_file_reads(path, buffered):
+    with open(path, 'rb') as f:
+        _, num_track_chunks, _ = parse_header(midi_file=f)
+        return [parse_track(midi_file=f, buffered=buffered) for _ in range(num_track_chunks)]
+
+
+def parse_with_mmap(path):
+    _, _, tracks = parse_midi_file(path)
+    return [track.events for track in tracks]
+
+
+def time_parser(parser, repeats):
+    best = None
+    num_events = 0
+    for _ in range(repeats):
+        start = time.perf_counter()
+        tracks = parser()
+        elapsed = time.perf_counter() - start
+        num_events = sum(len(events) for events in tracks)
+        best = elapsed if best is None else min(best, elapsed)
+    return num_events, best
+
+
+def bench_parser(paths, repeats=20):
+    results = []
+    for path in paths:
+        modes = [
+            ['per-byte reads', lambda: parse_with_file_reads(path, False)],
+            ['chunk buffer', lambda: parse_with_file_reads(path, True)],
+            ['mmap', lambda: parse_with_mmap(path)],
+        ]
+
+        baseline_rate = None
+        for mode, parser in modes:
+            num_events, elapsed = time_parser(parser, repeats)
+            rate = num_events / elapsed
+            if baseline_rate is None:
+                baseline_rate = rate
+            results.append([path, mode, str(num_events), f'{rate:,.0f}', f'{rate / baseline_rate:.2f}x'])
+    return results
+
+
+def make_dense_note_store(num_notes, polyphony=16, seed=0):
+    # Sustained chords on one channel with lots of overlapping notes on the same key
+    rng = random.Random(seed)
+    messages = []
+    for i in range(num_notes):
+        start = i * 4
+        end = start + rng.randint(1, polyphony * 4)
+        key = 60 + rng.randint(0, 11)
+        messages.append((start, 0x90, key, 64))
+        messages.append((end, 0x90, key, 0))
+    messages.sort(key=lambda message: message[0])
+
+    store = EventStore(1)
+    previous_tick = 0
+    for tick, status, key, vel in messages:
+        store.append(tick, tick - previous_tick, 0, status, [key, vel])
+        previous_tick = tick
+    return store
+
+
+def bench_note_pairing(sizes=(10_000, 100_000, 1_000_000)):
+    results = []
+    for num_notes in sizes:
+        song = Song(None, 96, make_dense_note_store(num_notes))
+        start = time.perf_counter()
+        notes = song.parse_notes()
+        elapsed = time.perf_counter() - start
+        results.append([str(num_notes), str(len(notes)), f'{elapsed:.3f}', f'{elapsed / num_notes * 1e9:,.0f}'])
+    return results
+
+
+def make_track_chunk(events):
+    # events is a list of (absolute tick, raw event bytes) in tick order
+    track_data = bytearray()
+    previous_tick = 0
+    for tick, event_bytes in events:
+        track_data += encode_variable_time(tick - previous_tick)
+        track_data += event_bytes
+        previous_tick = tick
+    track_data += b'\x00\xff\x2f\x00'
+    return b'MTrk' + len(track_data).to_bytes(4, "big") + bytes(track_data)
+
+
+def make_synthetic_midi(num_tracks=4, events_per_track=10_000, polyphony=4, running_status=0.9, controller_ratio=0.2,
+                        sysex_every=0, tempo_changes=0, division=480, seed=0):
+    # A format 1 file with a conductor track (tempo and meter changes) and num_tracks note tracks.
+    # Every knob that changes the decoder's work is exposed so files can be scaled one dimension at a time:
+    #   polyphony        notes held at once per track
+    #   running_status   chance that a repeated channel status byte is left out
+    #   controller_ratio share of channel events that are controller or pitch bend messages instead of notes
+    #   sysex_every      a short sysex message after this many events (0 for none)
+    #   tempo_changes    number of tempo changes spread over the song
+    rng = random.Random(seed)
+    track_chunks = []
+
+    song_length = 0
+    for track_id in range(num_tracks):
+        channel = track_id % 16
+        events = []
+        held_keys = []
+        tick = 0
+        while len(events) < events_per_track:
+            tick += rng.choice((0, 0, division // 4, division // 2, division))
+            if sysex_every and len(events) % sysex_every == sysex_every - 1:
+                events.append((tick, None, b'\xf0\x05\x7e\x7f\x09\x01\xf7'))
+            elif rng.random() < controller_ratio:
+                if rng.random() < 0.5:
+                    events.append((tick, 0xB0 | channel, bytes([rng.randint(0, 119), rng.randint(0, 127)])))
+                else:
+                    events.append((tick, 0xE0 | channel, bytes([rng.randint(0, 127), rng.randint(0, 127)])))
+            elif len(held_keys) >= polyphony or (held_keys and rng.random() < 0.5):
+                key = held_keys.pop(rng.randrange(len(held_keys)))
+                # Half of the releases are Note On with velocity 0, which is what makes running status pay off
+                if rng.random() < 0.5:
+                    events.append((tick, 0x90 | channel, bytes([key, 0])))
+                else:
+                    events.append((tick, 0x80 | channel, bytes([key, 64])))
+            else:
+                key = rng.randint(36, 96)
+                held_keys.append(key)
+                events.append((tick, 0x90 | channel, bytes([key, rng.randint(1, 127)])))
+        for key in held_keys:
+            tick += division
+            events.append((tick, 0x80 | channel, bytes([key, 64])))
+        song_length = max(song_length, tick)
+
+        raw_events = []
+        previous_status = None
+        for event_tick, status, data in events:
+            if status is None:
+                # Sysex doesn't touch running status, but write the next status out anyway to stay unambiguous
+                raw_events.append((event_tick, data))
+                previous_status = None
+            elif status == previous_status and rng.random() < running_status:
+                raw_events.append((event_tick, data))
+            else:
+                raw_events.append((event_tick, bytes([status]) + data))
+                previous_status = status
+        track_chunks.append(make_track_chunk(raw_events))
+
+    conductor_events = [(0, b'\xff\x58\x04\x04\x02\x18\x08'), (0, b'\xff\x51\x03\x07\xa1\x20')]
+    for i in range(tempo_changes):
+        tempo = rng.randint(300_000, 1_000_000)
+        conductor_events.append(((i + 1) * song_length // (tempo_changes + 1), b'\xff\x51\x03' + tempo.to_bytes(3, "big")))
+    track_chunks.insert(0, make_track_chunk(conductor_events))
+
+    header = b'MThd' + (6).to_bytes(4, "big") + (1).to_bytes(2, "big") + len(track_chunks).to_bytes(2, "big") + \
+        division.to_bytes(2, "big")
+    return header + b''.join(track_chunks)
+
+
+SYNTHETIC_FILES = {
+    'small': {'num_tracks': 2, 'events_per_track': 2_000},
+    'dense': {'num_tracks': 8, 'events_per_track': 20_000, 'polyphony': 8, 'tempo_changes': 50},
+    'controllers': {'num_tracks': 4, 'events_per_track': 20_000, 'controller_ratio': 0.8, 'sysex_every': 500},
+    'no running status': {'num_tracks': 4, 'events_per_track': 20_000, 'running_status': 0.0},
+}
+
+
+def time_function(function, repeats):
+    # Best and median wall time, best is the least noisy number to compare across runs
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings), statistics.median(timings)
+
+
+def make_benchmarks(name, midi_data):
+    # (benchmark name, function, units of work per call, unit name)
+    song = create_columnar_song(midi_data)
+    num_events = len(song.event_store)
+    track_chunk_start = 14 + 8 + int.from_bytes(midi_data[18:22], "big")  # First note track, past the conductor
+    track_chunk_end = track_chunk_start + 8 + int.from_bytes(midi_data[track_chunk_start + 4:track_chunk_start + 8],
+                                                             "big")
+    track_chunk = midi_data[track_chunk_start:track_chunk_end]
+    num_track_events = len(parse_track(io.BytesIO(track_chunk)))
+
+    rng = random.Random(0)
+    window_size = song.division * 4
+    ranges = [(start, start + window_size) for start in
+              (rng.randint(0, max(song.length - window_size, 0)) for _ in range(1000))]
+    chord_vectors = [[rng.random() if rng.random() < 0.3 else 0 for _ in range(12)] for _ in range(1000)]
+
+    def get_notes_in_ranges():
+        for start_tick, end_tick in ranges:
+            song.get_notes_in_range(start_tick, end_tick)
+
+    def match_chord_vectors():
+        # Clear the memo so every call does a real search
+        get_chord_library().match_cache.clear()
+        for chord_vector in chord_vectors:
+            match_chord_vector(chord_vector, limit=2)
+
+    return [
+        [f'{name}/parse_track', lambda: parse_track(io.BytesIO(track_chunk)), num_track_events, 'events'],
+        [f'{name}/parse_midi_data', lambda: parse_midi_data(midi_data), num_events, 'events'],
+        [f'{name}/parse_notes', song.parse_notes, num_events, 'events'],
+        [f'{name}/get_notes_in_range', get_notes_in_ranges, len(ranges), 'queries'],
+        [f'{name}/match_chord_vector', match_chord_vectors, len(chord_vectors), 'vectors'],
+        [f'{name}/song_str', lambda: str(song), num_events, 'events'],
+        [f'{name}/create_song', lambda: create_columnar_song(midi_data), num_events, 'events'],
+        [f'{name}/encode_song', lambda: encode_song(song), num_events, 'events'],
+    ]
+
+
+def run_suite(names=None, repeats=5, pattern=None):
+    results = []
+    for name, options in SYNTHETIC_FILES.items():
+        if names and name not in names:
+            continue
+        midi_data = make_synthetic_midi(**options)
+        for benchmark, function, units, unit_name in make_benchmarks(name, midi_data):
+            if pattern and pattern not in benchmark:
+                continue
+            best, median = time_function(function, repeats)
+            results.append({
+                'name': benchmark,
+                'best': best,
+                'median': median,
+                'units': units,
+                'unit': unit_name,
+                'rate': units / best,
+            })
+    return results
+
+
+def compare_results(results, baseline, threshold=0.1):
+    # (name, baseline best, current best, ratio, regressed) for every benchmark in both runs
+    baseline_times = {result['name']: result['best'] for result in baseline['results']}
+    comparisons = []
+    for result in results:
+        if result['name'] not in baseline_times:
+            continue
+        ratio = result['best'] / baseline_times[result['name']]
+        comparisons.append([result['name'], baseline_times[result['name']], result['best'], ratio,
+                            ratio > 1 + threshold])
+    return comparisons
+
+
+def get_environment():
+    return {'python': platform.python_version(), 'implementation': platform.python_implementation(),
+            'machine': platform.machine(), 'platform': platform.platform()}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Parser and analysis benchmarks')
+    parser.add_argument('--files', nargs='*', metavar='PATH',
+                        help='time the parser modes on these files instead of running the synthetic suite')
+    parser.add_argument('--suite', nargs='*', metavar='NAME', help=f'synthetic files to run, any of '
+                        f'{", ".join(SYNTHETIC_FILES)} (default all)')
+    parser.add_argument('--filter', help='only run benchmarks whose name contains this')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--json', metavar='PATH', help='write results as JSON, - for stdout')
+    parser.add_argument('--baseline', metavar='PATH', help='compare against a JSON file written by --json')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='slowdown past which a benchmark counts as a regression (default 0.1 = 10%%)')
+    args = parser.parse_args(argv)
+
+    if args.files is not None:
+        rows = bench_parser(args.files or SAMPLE_FILES)
+        print(f'{"File":<24}{"Mode":<16}{"Events":>8}{"Events/sec":>14}{"Speedup":>10}')
+        for row in rows:
+            print(f'{row[0]:<24}{row[1]:<16}{row[2]:>8}{row[3]:>14}{row[4]:>10}')
+
+        print()
+        print(f'{"Notes":>10}{"Paired":>10}{"Seconds":>10}{"ns/note":>10}')
+        for row in bench_note_pairing():
+            print(f'{row[0]:>10}{row[1]:>10}{row[2]:>10}{row[3]:>10}')
+        return 0
+
+    results = run_suite(args.suite, args.repeats, args.filter)
+    output = {'environment': get_environment(), 'repeats': args.repeats, 'results': results}
+    if args.json == '-':
+        json.dump(output, sys.stdout, indent=2)
+        print()
+    else:
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(output, f, indent=2)
+        print(f'{"Benchmark":<40}{"Best (ms)":>12}{"Median (ms)":>14}{"Rate":>16}')
+        for result in results:
+            print(f'{result["name"]:<40}{result["best"] * 1000:>12.2f}{result["median"] * 1000:>14.2f}'
+                  f'{result["rate"]:>12,.0f} {result["unit"]}/s')
+
+    if args.baseline is None:
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    comparisons = compare_results(results, baseline, args.threshold)
+    print(f'\n{"Benchmark":<40}{"Baseline (ms)":>14}{"Current (ms)":>14}{"Change":>10}', file=sys.stderr)
+    for name, baseline_best, best, ratio, regressed in comparisons:
+        print(f'{name:<40}{baseline_best * 1000:>14.2f}{best * 1000:>14.2f}{ratio - 1:>+10.1%}'
+              f'{"  REGRESSION" if regressed else ""}', file=sys.stderr)
+    return 1 if any(comparison[4] for comparison in comparisons) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
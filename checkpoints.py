@@ -0,0 +1,190 @@
+import heapq
+import mmap
+import os
+from array import array
+from bisect import bisect_left
+from operator import itemgetter
+
+from file_utils import pack_header, read_header, write_file_atomically
+from parse_midi import MeterMap, STATUS_BYTES, TrackEvent, TrackParser, check_header, get_payload_start, \
+    get_time_signature, get_track_chunks, parse_header_data
+
+CHECKPOINT_MAGIC = b'MOTIFCKP'
+CHECKPOINT_FORMAT_VERSION = 1
+CHECKPOINT_SUFFIX = '.ckp'
+DEFAULT_CHECKPOINT_INTERVAL = 256
+
+
+class TrackCheckpoints:
+    # Every interval events: the byte offset of the next event, the absolute tick before its delta and the
+    # running status in effect, which is all the decoder needs to pick the track up from there
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.offsets = array('q')
+        self.ticks = array('q')
+        self.running_statuses = array('h')
+        self.length = 0
+
+    def add(self, offset, tick, running_status):
+        self.offsets.append(offset)
+        self.ticks.append(tick)
+        self.running_statuses.append(running_status)
+
+    def find(self, tick):
+        # Last checkpoint strictly before tick, so events sitting exactly on tick are never behind it
+        i = max(bisect_left(self.ticks, tick) - 1, 0)
+        return self.offsets[i], self.ticks[i], self.running_statuses[i]
+
+
+class CheckpointIndex:
+    # Sparse per-track checkpoints for a file, so a tick range can be decoded without reading everything before it.
+    # A read bisects to the nearest checkpoint in each track and decodes at most interval events it doesn't need.
+    # Time signatures are collected while building so measure numbers can be turned into tick ranges.
+    def __init__(self, midi_format, division, tracks, time_signatures, interval=DEFAULT_CHECKPOINT_INTERVAL,
+                 file_size=0, file_mtime=0):
+        self.midi_format = midi_format
+        self.division = division
+        self.tracks = tracks
+        self.time_signatures = time_signatures
+        self.interval = interval
+        self.file_size = file_size
+        self.file_mtime = file_mtime
+        self.length = max((track.length for track in tracks), default=0)
+        self.meter_map = MeterMap(division, time_signatures, self.length)
+
+    @classmethod
+    def build(cls, midi_data, interval=DEFAULT_CHECKPOINT_INTERVAL):
+        midi_format, num_track_chunks, division = parse_header_data(midi_data)
+        check_header(midi_format, division)
+
+        tracks = []
+        time_signatures = []
+        for i, (start, end) in enumerate(get_track_chunks(midi_data, num_track_chunks)):
+            checkpoints = TrackCheckpoints(start, end)
+            parser = TrackParser(midi_data, start, end, i)
+            current_tick = 0
+            num_events = 0
+            while parser.offset < parser.end:
+                if num_events % interval == 0:
+                    checkpoints.add(parser.offset, current_tick, parser.running_status)
+                v_time, status, data = parser.read_raw_event()
+                current_tick += v_time
+                num_events += 1
+                if status == 0xFF and data[0] == 0x58:
+                    time_signatures.append((current_tick, *get_time_signature(data[get_payload_start(status, data):])))
+            checkpoints.length = current_tick
+            tracks.append(checkpoints)
+
+        # Stable, so ties stay in track order like the merged event stream
+        time_signatures.sort(key=itemgetter(0))
+        return cls(midi_format, division, tracks, time_signatures, interval)
+
+    def iter_track_range(self, midi_data, track_id, start_tick, end_tick):
+        checkpoints = self.tracks[track_id]
+        offset, current_tick, running_status = checkpoints.find(start_tick)
+        parser = TrackParser(midi_data, checkpoints.start, checkpoints.end, track_id)
+        parser.offset = offset
+        parser.running_status = running_status
+        while parser.offset < parser.end:
+            v_time, status, data = parser.read_raw_event()
+            current_tick += v_time
+            if current_tick >= end_tick:
+                return
+            if current_tick >= start_tick:
+                event = TrackEvent(v_time, STATUS_BYTES[status], data)
+                event.track_id = track_id
+                yield current_tick, track_id, event
+
+    def read_range(self, midi_data, start_tick, end_tick, track_ids=None):
+        # (absolute tick, track id, event) for start_tick <= tick < end_tick, merged across tracks in tick order.
+        # midi_data has to be the same bytes (or mmap) the index was built from.
+        if track_ids is None:
+            track_ids = range(len(self.tracks))
+        return heapq.merge(*[self.iter_track_range(midi_data, track_id, start_tick, end_tick)
+                             for track_id in track_ids], key=itemgetter(0))
+
+    def get_measure_range(self, first_measure, last_measure):
+        # Ticks covering measures first_measure to last_measure inclusive, counted from 1
+        start_tick = self.meter_map.get_measure_start(first_measure)
+        if last_measure < len(self.meter_map.measure_starts):
+            return start_tick, self.meter_map.get_measure_start(last_measure + 1)
+        return start_tick, self.length + 1
+
+    def read_measures(self, midi_data, first_measure, last_measure, track_ids=None):
+        return self.read_range(midi_data, *self.get_measure_range(first_measure, last_measure), track_ids)
+
+    def save(self, path):
+        header = {
+            'midi_format': self.midi_format,
+            'division': self.division,
+            'interval': self.interval,
+            'file_size': self.file_size,
+            'file_mtime': self.file_mtime,
+            'time_signatures': self.time_signatures,
+            'tracks': [[track.start, track.end, track.length, len(track.offsets)] for track in self.tracks],
+        }
+        chunks = [pack_header(CHECKPOINT_MAGIC, CHECKPOINT_FORMAT_VERSION, header)]
+        for track in self.tracks:
+            chunks += [track.offsets.tobytes(), track.ticks.tobytes(), track.running_statuses.tobytes()]
+        write_file_atomically(path, chunks)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            header = read_header(f, CHECKPOINT_MAGIC, CHECKPOINT_FORMAT_VERSION, 'checkpoint index')
+            tracks = []
+            for start, end, length, num_checkpoints in header['tracks']:
+                checkpoints = TrackCheckpoints(start, end)
+                checkpoints.offsets.fromfile(f, num_checkpoints)
+                checkpoints.ticks.fromfile(f, num_checkpoints)
+                checkpoints.running_statuses.fromfile(f, num_checkpoints)
+                checkpoints.length = length
+                tracks.append(checkpoints)
+
+        return cls(header['midi_format'], header['division'], tracks,
+                   [tuple(time_signature) for time_signature in header['time_signatures']], header['interval'],
+                   header['file_size'], header['file_mtime'])
+
+
+def get_checkpoint_index(path, interval=DEFAULT_CHECKPOINT_INTERVAL, sidecar=True):
+    # Uses the sidecar next to the file when it was built from this exact size and mtime with the same interval,
+    # otherwise builds the index (one full decode) and writes the sidecar for next time
+    stat = os.stat(path)
+    sidecar_path = path + CHECKPOINT_SUFFIX
+    if sidecar:
+        try:
+            index = CheckpointIndex.load(sidecar_path)
+            if (index.file_size, index.file_mtime, index.interval) == (stat.st_size, stat.st_mtime_ns, interval):
+                return index
+        except (OSError, ValueError, KeyError):
+            pass
+
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as midi_data:
+            index = CheckpointIndex.build(midi_data, interval)
+    index.file_size = stat.st_size
+    index.file_mtime = stat.st_mtime_ns
+    if sidecar:
+        # Best effort, a read-only library still gets its ranges read, just without the sidecar
+        try:
+            index.save(sidecar_path)
+        except OSError:
+            pass
+    return index
+
+
+def read_file_range(path, start_tick, end_tick, track_ids=None, interval=DEFAULT_CHECKPOINT_INTERVAL, sidecar=True):
+    # Lazily yields (absolute tick, track id, event) for a tick range, decoding only near the range
+    index = get_checkpoint_index(path, interval, sidecar)
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as midi_data:
+            yield from index.read_range(midi_data, start_tick, end_tick, track_ids)
+
+
+def read_file_measures(path, first_measure, last_measure, track_ids=None, interval=DEFAULT_CHECKPOINT_INTERVAL,
+                       sidecar=True):
+    index = get_checkpoint_index(path, interval, sidecar)
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as midi_data:
+            yield from index.read_measures(midi_data, first_measure, last_measure, track_ids)
@@ -0,0 +1,191 @@
+import argparse
+import hashlib
+import random
+import sys
+
+from benchmarks import make_track_chunk
+from motifs import build_lcp_array, build_suffix_array, iter_maximal_repeats
+from parse_midi import create_song, parse_header, parse_header_data, parse_midi_data, parse_midi_file, parse_track
+from write_midi import encode_header, encode_song, encode_variable_time
+
+SAMPLE_FILES = ['Twinkle.mid', 'snowman.mid', 'world-1-birabuto.mid']
+
+# Digests of (track, delta, status, data) for every event the original byte-by-byte parser read from the samples.
+# It threw sysex data away, so only the status of those goes in.
+SAMPLE_EVENT_DIGESTS = {
+    'Twinkle.mid': '6e18adf4d6ff9fc27ed56d620aedb402',
+    'snowman.mid': '9a3b159927cb55f75b993cf009a04275',
+    'world-1-birabuto.mid': '0250ef5720f5671c6c7ffb64549edd32',
+}
+
+# Whether each sample was written with running status, so it can be written back the same way
+SAMPLE_RUNNING_STATUS = {
+    'Twinkle.mid': False,
+    'snowman.mid': True,
+    'world-1-birabuto.mid': False,
+}
+
+
+def get_event_digest(tracks):
+    event_digest = hashlib.blake2b(digest_size=16)
+    for i, events in enumerate(tracks):
+        for event in events:
+            status = event.command[0]
+            data = b'' if status in (0xF0, 0xF7) else bytes(event.data)
+            event_digest.update(repr((i, event.tick, status, data)).encode())
+    return event_digest.hexdigest()
+
+
+def get_event_keys(events):
+    return [(event.tick, bytes(event.command), bytes(event.data)) for event in events]
+
+
+def check_parser_modes():
+    # Every way of reading a file has to give the same events, and the same events the original parser gave
+    for path in SAMPLE_FILES:
+        with open(path, 'rb') as f:
+            _, num_track_chunks, _ = parse_header(midi_file=f)
+            unbuffered = [parse_track(midi_file=f, buffered=False) for _ in range(num_track_chunks)]
+        with open(path, 'rb') as f:
+            _, num_track_chunks, _ = parse_header(midi_file=f)
+            buffered = [parse_track(midi_file=f) for _ in range(num_track_chunks)]
+        _, _, tracks = parse_midi_file(path)
+
+        assert get_event_digest(unbuffered) == SAMPLE_EVENT_DIGESTS[path], f'{path}: events changed'
+        assert [get_event_keys(events) for events in unbuffered] == [get_event_keys(events) for events in buffered] \
+            == [get_event_keys(track.events) for track in tracks], f'{path}: parser modes disagree'
+
+        merged = [(tick, event.track_id, bytes(event.command), bytes(event.data))
+                  for tick, event in create_song(path).iter_events()]
+        columnar = [(tick, event.track_id, bytes(event.command), bytes(event.data))
+                    for tick, event in create_song(path, columnar=True).iter_events()]
+        assert merged == columnar, f'{path}: columnar events differ'
+    return f'{len(SAMPLE_FILES)} samples'
+
+
+def check_long_meta_lengths():
+    # Meta and sysex lengths past 127 take more than one length byte
+    text = bytes(range(32, 127)) * 3
+    sysex = bytes([0x7E] + [i % 128 for i in range(300)] + [0xF7])
+    midi_data = encode_header(0, 1, 96) + make_track_chunk([
+        (0, b'\xff\x01' + encode_variable_time(len(text)) + text),
+        (0, b'\xf0' + encode_variable_time(len(sysex)) + sysex),
+        (0, b'\x90\x3c\x40'),
+        (96, b'\x80\x3c\x00'),
+    ])
+    _, _, tracks = parse_midi_data(midi_data)
+    events = tracks[0].events
+    assert bytes(events[0].payload) == text and bytes(events[1].payload) == sysex, 'long payloads misread'
+    assert len(events) == 5, 'events after a long payload misread'
+    return f'{len(text)} and {len(sysex)} byte payloads'
+
+
+def check_truncated_track():
+    with open('snowman.mid', 'rb') as f:
+        midi_data = f.read()
+    try:
+        parse_midi_data(midi_data[:len(midi_data) // 2])
+    except ValueError:
+        return 'rejected'
+    raise AssertionError('truncated file parsed without an error')
+
+
+def check_round_trips():
+    # Encoding a parsed sample the way it was written gives back the file byte for byte, from both song layouts.
+    # Written the other way the bytes change but the events have to come back the same.
+    for path, use_running_status in SAMPLE_RUNNING_STATUS.items():
+        with open(path, 'rb') as f:
+            midi_data = f.read()
+        midi_format, _, _ = parse_header_data(midi_data)
+        for columnar in (False, True):
+            song = create_song(path, columnar=columnar)
+            assert encode_song(song, midi_format, use_running_status) == midi_data, \
+                f'{path}: round trip differs (columnar={columnar})'
+            _, _, tracks = parse_midi_data(encode_song(song, midi_format, not use_running_status))
+            assert [get_event_keys(track.events) for track in tracks] == \
+                [get_event_keys(track.events) for track in parse_midi_data(midi_data)[2]], \
+                f'{path}: events differ without running status (columnar={columnar})'
+    return f'{len(SAMPLE_FILES)} samples byte exact'
+
+
+def find_maximal_repeats(sequence, min_length, max_length):
+    # Brute force version of iter_maximal_repeats: every pattern that occurs more than once, preceded by different
+    # symbols and followed by different symbols (or cut at max_length), as (length, sorted positions)
+    n = len(sequence)
+    repeats = set()
+    for length in range(min_length, max_length + 1):
+        positions = {}
+        for i in range(n - length + 1):
+            positions.setdefault(tuple(sequence[i:i + length]), []).append(i)
+        for occurrences in positions.values():
+            if len(occurrences) < 2:
+                continue
+            left_symbols = {sequence[i - 1] if i > 0 else ('start', i) for i in occurrences}
+            right_symbols = {sequence[i + length] if i + length < n else ('end', i) for i in occurrences}
+            if len(left_symbols) > 1 and (len(right_symbols) > 1 or length == max_length):
+                repeats.add((length, tuple(occurrences)))
+    return repeats
+
+
+def check_maximal_repeats(num_trials=500, seed=0):
+    # Small random sequences with unique separators, like the joined melody lines find_motifs builds
+    rng = random.Random(seed)
+    for _ in range(num_trials):
+        sequence = [rng.randint(0, rng.randint(1, 3)) for _ in range(rng.randint(2, 40))]
+        for separator in range(rng.randint(0, 3)):
+            sequence[rng.randrange(len(sequence))] = -2 - separator
+        sequence.append(-1)
+        min_length = rng.randint(1, 3)
+        max_length = rng.randint(min_length, 8)
+
+        suffix_array = build_suffix_array(sequence)
+        assert suffix_array == sorted(range(len(sequence)), key=lambda i: sequence[i:]), \
+            f'suffix array wrong for {sequence}'
+        lcp = build_lcp_array(sequence, suffix_array)
+        for i in range(1, len(sequence)):
+            a, b = sequence[suffix_array[i - 1]:], sequence[suffix_array[i]:]
+            common = next((j for j, (x, y) in enumerate(zip(a, b)) if x != y), min(len(a), len(b)))
+            assert lcp[i] == common, f'lcp wrong for {sequence}'
+
+        repeats = {(length, tuple(sorted(suffix_array[start:end + 1])))
+                   for length, start, end in iter_maximal_repeats(sequence, suffix_array, lcp, min_length,
+                                                                 max_length)}
+        assert repeats == find_maximal_repeats(sequence, min_length, max_length), \
+            f'maximal repeats wrong for {sequence} between {min_length} and {max_length}'
+    return f'{num_trials} random sequences'
+
+
+CHECKS = {
+    'parser_modes': check_parser_modes,
+    'long_meta_lengths': check_long_meta_lengths,
+    'truncated_track': check_truncated_track,
+    'round_trips': check_round_trips,
+    'maximal_repeats': check_maximal_repeats,
+}
+
+
+def main(argv=None):
+    # Correctness checks against the sample files and known answers, meant to be run after every parser change
+    parser = argparse.ArgumentParser(description='Parser and analysis correctness checks')
+    parser.add_argument('names', nargs='*', metavar='NAME', help=f'checks to run, any of {", ".join(CHECKS)} '
+                        f'(default all)')
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.names if name not in CHECKS]
+    if unknown:
+        parser.error(f'unknown checks: {", ".join(unknown)}')
+
+    failed = 0
+    for name in args.names or CHECKS:
+        try:
+            result = CHECKS[name]()
+        except Exception as e:
+            # A parser error counts as a failed check too, the rest still run
+            failed += 1
+            print(f'{name:<24}FAILED  {type(e).__name__}: {e}')
+        else:
+            print(f'{name:<24}ok      {result}')
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
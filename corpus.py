@@ -0,0 +1,120 @@
+import mmap
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import islice
+
+from midi_cache import load_cached_song
+from parse_midi import EventStore, Song, TrackParser, check_header, create_song, get_track_chunks, parse_header_data
+
+
+class ChunkIndex:
+    # Where everything lives in a file, found from the chunk headers alone without decoding any events
+    def __init__(self, path, midi_format, division, track_chunks):
+        self.path = path
+        self.midi_format = midi_format
+        self.division = division
+        self.track_chunks = track_chunks
+
+
+def scan_chunks(path):
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as midi_data:
+            midi_format, num_track_chunks, division = parse_header_data(midi_data)
+            return ChunkIndex(path, midi_format, division, get_track_chunks(midi_data, num_track_chunks))
+
+
+def parse_track_chunk(path, start, end, track_id):
+    # Worker entry point, only takes picklable arguments so it can run in another process.
+    # Hands back the track as EventStore columns, which pickle as a few flat buffers instead of an object per event.
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as midi_data:
+            store = EventStore(1)
+            store.append_track(TrackParser(midi_data, start, end, track_id))
+            return store
+
+
+def create_song_parallel(path, executor):
+    # Decodes the tracks of one file side by side on the given executor, into a columnar Song
+    chunk_index = scan_chunks(path)
+    check_header(chunk_index.midi_format, chunk_index.division)
+
+    futures = [executor.submit(parse_track_chunk, path, start, end, i)
+               for i, (start, end) in enumerate(chunk_index.track_chunks)]
+    event_store = EventStore(len(futures))
+    for future in futures:
+        event_store.extend(future.result())
+    event_store.sort()
+    return Song(None, chunk_index.division, event_store)
+
+
+def load_corpus_chunk(paths, load_song, reducer=None):
+    # Worker entry point, returns (path, result, error) for every path. A file that fails to load comes back with
+    # its error instead of taking the rest of the corpus down with it.
+    results = []
+    for path in paths:
+        try:
+            song = load_song(path)
+            results.append((path, song if reducer is None else reducer(song), None))
+        except Exception as e:
+            results.append((path, None, f'{type(e).__name__}: {e}'))
+    return results
+
+
+def iter_corpus_results(paths, load_song, reducer=None, max_workers=None, chunksize=1, max_pending=None):
+    # (path, result, error) in the same order as paths. Only max_pending chunks are submitted ahead of what's
+    # been consumed, so a slow consumer holds back the workers instead of results piling up in memory.
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    if max_pending is None:
+        max_pending = max_workers * 2
+
+    paths = iter(paths)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        while True:
+            while len(pending) < max_pending:
+                chunk = list(islice(paths, chunksize))
+                if not chunk:
+                    break
+                pending.append(executor.submit(load_corpus_chunk, chunk, load_song, reducer))
+            if not pending:
+                return
+            yield from pending.popleft().result()
+
+
+def load_corpus(paths, max_workers=None, chunksize=1, batch_size=None, cache_dir=None, reducer=None, errors=None,
+                max_pending=None):
+    # Songs come back in the same order as paths, as a flat stream or as lists of batch_size songs.
+    # Workers send columnar songs, which are far cheaper to pickle than TrackEvent lists. Pass a picklable reducer
+    # to run on each song in the worker and get its (ideally small) result back instead of the song.
+    # Files that fail to load are skipped, pass a list as errors to collect (path, error message) for them.
+    # With a cache_dir, workers share one on-disk SongCache and only decode files they haven't seen before.
+    load_song = partial(create_song, columnar=True) if cache_dir is None else partial(load_cached_song,
+                                                                                      cache_dir=cache_dir)
+    batch = []
+    for path, result, error in iter_corpus_results(paths, load_song, reducer, max_workers, chunksize, max_pending):
+        if error is not None:
+            if errors is not None:
+                errors.append((path, error))
+            continue
+        if batch_size is None:
+            yield result
+            continue
+
+        batch.append(result)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def find_midi_files(root):
+    midi_files = []
+    for directory, _, file_names in os.walk(root):
+        for file_name in file_names:
+            if file_name.lower().endswith(('.mid', '.midi')):
+                midi_files.append(os.path.join(directory, file_name))
+    return sorted(midi_files)
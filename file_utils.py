@@ -0,0 +1,41 @@
+import json
+import os
+import tempfile
+
+
+def write_file_atomically(path, chunks):
+    # Writes chunks to a temp file next to path, syncs it and renames it into place, so readers only ever see a
+    # complete file. The temp file is removed whatever goes wrong on the way, interrupts included.
+    file_descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    try:
+        with os.fdopen(file_descriptor, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+def pack_header(magic, version, header):
+    # Every file we write starts with its magic, a little endian format version and a length prefixed JSON header
+    header_bytes = json.dumps(header).encode()
+    return magic + version.to_bytes(4, "little") + len(header_bytes).to_bytes(4, "little") + header_bytes
+
+
+def read_header(f, magic, version, description):
+    # Reads what pack_header wrote from a file (or mmap), leaving it positioned just past the header
+    if f.read(len(magic)) != magic:
+        raise ValueError(f'Invalid {description} file')
+    if int.from_bytes(f.read(4), "little") != version:
+        raise ValueError(f'Unsupported {description} version')
+    header_length = int.from_bytes(f.read(4), "little")
+    header_bytes = f.read(header_length)
+    if len(header_bytes) != header_length:
+        raise ValueError(f'Truncated {description} file')
+    return json.loads(header_bytes)
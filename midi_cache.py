@@ -0,0 +1,231 @@
+import hashlib
+import mmap
+import os
+import sys
+from array import array
+
+from file_utils import pack_header, read_header, write_file_atomically
+from parse_midi import PARSER_VERSION, EventStore, MeterMap, Song, TempoMap, create_columnar_song
+
+CACHE_MAGIC = b'MOTIFSNG'
+CACHE_FORMAT_VERSION = 3
+CACHE_SUFFIX = '.song'
+
+# (section name, object attribute, array typecode) for every array stored in a cache file
+EVENT_SECTIONS = [
+    ['events.ticks', 'ticks', 'q'],
+    ['events.deltas', 'deltas', 'I'],
+    ['events.track_ids', 'track_ids', 'H'],
+    ['events.statuses', 'statuses', 'B'],
+    ['events.data1', 'data1', 'B'],
+    ['events.data2', 'data2', 'B'],
+    ['events.meta_indices', 'meta_indices', 'q'],
+    ['events.meta_starts', 'meta_starts', 'q'],
+    ['events.payload_offsets', 'payload_offsets', 'q'],
+    ['events.payload_lengths', 'payload_lengths', 'q'],
+    ['events.meta_data', 'meta_data', 'B'],
+]
+NOTE_SECTIONS = [
+    ['notes.start_ticks', 'start_tick', 'q'],
+    ['notes.end_ticks', 'end_tick', 'q'],
+    ['notes.start_times', 'start_time', 'd'],
+    ['notes.end_times', 'end_time', 'd'],
+    ['notes.channels', 'channel', 'B'],
+    ['notes.keys', 'key', 'B'],
+    ['notes.velocities', 'velocity', 'B'],
+]
+TEMPO_SECTIONS = [
+    ['tempo.ticks', 'ticks', 'q'],
+    ['tempo.tempos', 'tempos', 'q'],
+    ['tempo.offsets', 'offsets', 'd'],
+]
+METER_SECTIONS = [
+    ['meter.segment_ticks', 'segment_ticks', 'q'],
+    ['meter.first_measures', 'first_measures', 'q'],
+    ['meter.numerators', 'numerators', 'q'],
+    ['meter.denominator_powers', 'denominator_powers', 'q'],
+    ['meter.measure_starts', 'measure_starts', 'q'],
+]
+
+
+def get_cache_key(midi_data, note_policy='fifo'):
+    # Content hash plus everything else that changes the analysis, so edited files and parser upgrades miss
+    content_hash = hashlib.blake2b(midi_data, digest_size=20)
+    content_hash.update(f'|{PARSER_VERSION}|{CACHE_FORMAT_VERSION}|{note_policy}'.encode())
+    return content_hash.hexdigest()
+
+
+def serialize_song(song):
+    sections = []
+    for name, attribute, typecode in EVENT_SECTIONS:
+        sections.append([name, typecode, array(typecode, bytes(getattr(song.event_store, attribute)))])
+    for name, attribute, typecode in NOTE_SECTIONS:
+        sections.append([name, typecode, array(typecode, [getattr(note, attribute) for note in song.notes])])
+    sections.append(['notes.index', 'q', array('q', song.note_index.max_ends)])
+    for name, attribute, typecode in TEMPO_SECTIONS:
+        sections.append([name, typecode, array(typecode, getattr(song.tempo_map, attribute))])
+    for name, attribute, typecode in METER_SECTIONS:
+        sections.append([name, typecode, array(typecode, getattr(song.meter_map, attribute))])
+
+    # Every section starts on an 8 byte boundary so it can be cast in place once mapped back in
+    directory = {
+        'parser_version': PARSER_VERSION,
+        'byteorder': sys.byteorder,
+        'division': song.division,
+        'note_policy': song.note_policy,
+        'num_tracks': song.event_store.num_tracks,
+        'channels': song.channels,
+        'length': song.length,
+        'sections': {},
+    }
+    offset = 0
+    for name, typecode, column in sections:
+        directory['sections'][name] = [typecode, offset, len(column)]
+        offset += -(-len(column) * column.itemsize // 8) * 8
+
+    header = pack_header(CACHE_MAGIC, CACHE_FORMAT_VERSION, directory)
+    header_length = -(-len(header) // 8) * 8
+    output = bytearray(header_length + offset)
+    output[0:len(header)] = header
+    for name, typecode, column in sections:
+        start = header_length + directory['sections'][name][1]
+        column_bytes = column.tobytes()
+        output[start:start + len(column_bytes)] = column_bytes
+    return output
+
+
+def read_directory(cache_data):
+    # cache_data is the mapped file, read from the start like any other file
+    cache_data.seek(0)
+    directory = read_header(cache_data, CACHE_MAGIC, CACHE_FORMAT_VERSION, 'cache')
+    if directory['parser_version'] != PARSER_VERSION or directory['byteorder'] != sys.byteorder:
+        raise ValueError('Cache file was written by a different parser or platform')
+    return directory, -(-cache_data.tell() // 8) * 8
+
+
+def deserialize_song(cache_data):
+    # The event columns stay as memoryviews straight over cache_data, everything else is small enough to copy
+    directory, header_length = read_directory(cache_data)
+    view = memoryview(cache_data)
+
+    def get_section(name):
+        typecode, offset, count = directory['sections'][name]
+        start = header_length + offset
+        end = start + count * array(typecode).itemsize
+        # Slicing past the end would quietly come back short, so a cut off file has to be caught here
+        if offset < 0 or count < 0 or end > len(view):
+            raise ValueError('Truncated cache file')
+        return view[start:end].cast(typecode)
+
+    event_store = EventStore.__new__(EventStore)
+    event_store.num_tracks = directory['num_tracks']
+    for name, attribute, _ in EVENT_SECTIONS:
+        setattr(event_store, attribute, get_section(name))
+
+    # Notes and their index stay as columns over cache_data too, the Song only builds them when they're used
+    note_columns = [get_section(name) for name, _, _ in NOTE_SECTIONS]
+
+    tempo_map = TempoMap.__new__(TempoMap)
+    tempo_map.division = directory['division']
+    for name, attribute, typecode in TEMPO_SECTIONS:
+        setattr(tempo_map, attribute, array(typecode, get_section(name)))
+
+    meter_map = MeterMap.__new__(MeterMap)
+    meter_map.division = directory['division']
+    meter_map.length = directory['length']
+    meter_map.beat_grids = {}
+    for name, attribute, typecode in METER_SECTIONS:
+        setattr(meter_map, attribute, array(typecode, get_section(name)))
+
+    return Song.restore(directory['division'], event_store, directory['note_policy'], note_columns,
+                        directory['channels'], directory['length'], tempo_map, meter_map, get_section('notes.index'))
+
+
+class SongCache:
+    # Decoded songs on disk, one file per content hash sharded by the first two hex digits. Files are written to
+    # a temp file and renamed into place, so other processes only ever see complete entries. Least recently used
+    # entries (by mtime, bumped on every hit) are evicted once the directory grows past max_bytes.
+    def __init__(self, cache_dir, max_bytes=1 << 30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.approx_size = None
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + CACHE_SUFFIX)
+
+    def load(self, key):
+        path = self.get_path(key)
+        try:
+            with open(path, 'rb') as f:
+                cache_data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            os.utime(path)
+        except (FileNotFoundError, ValueError):
+            return None
+
+        try:
+            return deserialize_song(cache_data)
+        except (ValueError, KeyError, TypeError):
+            # Corrupt or stale entry, drop it and parse again
+            self.remove(path)
+            return None
+
+    def store(self, key, song):
+        path = self.get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        cache_data = serialize_song(song)
+        write_file_atomically(path, [cache_data])
+
+        if self.approx_size is None:
+            self.approx_size = self.get_size()
+        else:
+            self.approx_size += len(cache_data)
+        if self.approx_size > self.max_bytes:
+            self.evict()
+
+    def get_song(self, path, note_policy='fifo'):
+        with open(path, 'rb') as f:
+            midi_data = f.read()
+        key = get_cache_key(midi_data, note_policy)
+        song = self.load(key)
+        if song is None:
+            song = create_columnar_song(midi_data, note_policy)
+            self.store(key, song)
+        return song
+
+    def iter_entries(self):
+        for shard in os.scandir(self.cache_dir):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith(CACHE_SUFFIX):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    yield entry.path, stat.st_size, stat.st_mtime
+
+    def get_size(self):
+        return sum(size for _, size, _ in self.iter_entries())
+
+    def evict(self, target_fraction=0.9):
+        # Other processes may be evicting at the same time, so files vanishing underneath us is fine.
+        # On POSIX an entry that's mapped by a reader stays readable after it's unlinked.
+        entries = sorted(self.iter_entries(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total <= self.max_bytes * target_fraction:
+                break
+            self.remove(path)
+            total -= size
+        self.approx_size = total
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def load_cached_song(path, cache_dir, max_bytes=1 << 30, note_policy='fifo'):
+    return SongCache(cache_dir, max_bytes).get_song(path, note_policy)
@@ -0,0 +1,206 @@
+import math
+from bisect import bisect_right
+
+MOTIF_MODES = ['interval', 'rhythm', 'both']
+IOI_RATIO_STEPS = 12  # Inter-onset ratios are quantized to this many steps per doubling
+
+
+class MotifOccurrence:
+    def __init__(self, channel, notes):
+        self.channel = channel
+        self.notes = notes
+        self.start_tick = notes[0].start_tick
+        self.end_tick = max(note.end_tick for note in notes)
+
+    def __repr__(self):
+        return f'MotifOccurrence(channel={self.channel}, start_tick={self.start_tick}, end_tick={self.end_tick})'
+
+
+class Motif:
+    # A repeated pattern of symbols (semitone intervals, inter-onset ratio steps or both) and every
+    # non-overlapping place it occurs, in song order
+    def __init__(self, pattern, occurrences):
+        self.pattern = pattern
+        self.occurrences = occurrences
+
+    @property
+    def support(self):
+        return len(self.occurrences)
+
+    @property
+    def num_notes(self):
+        return len(self.occurrences[0].notes)
+
+    def __repr__(self):
+        return f'Motif(pattern={self.pattern}, support={self.support}, num_notes={self.num_notes})'
+
+
+def get_melody_lines(notes, include_percussion=False):
+    # One line per channel, keeping only the highest note at each onset (skyline) so chords collapse to a melody
+    lines = {}
+    for note in notes:
+        if note.channel == 0x9 and not include_percussion:
+            continue
+        line = lines.setdefault(note.channel, [])
+        if line and line[-1].start_tick == note.start_tick:
+            if note.key > line[-1].key:
+                line[-1] = note
+        else:
+            line.append(note)
+    return lines
+
+
+def get_interval_symbols(line):
+    return [line[i + 1].key - line[i].key for i in range(len(line) - 1)]
+
+
+def get_rhythm_symbols(line):
+    # Tempo invariant: how much longer or shorter each inter-onset interval is than the one before it
+    iois = [line[i + 1].start_tick - line[i].start_tick for i in range(len(line) - 1)]
+    return [round(math.log2(iois[i + 1] / iois[i]) * IOI_RATIO_STEPS) for i in range(len(iois) - 1)]
+
+
+def get_symbols(line, mode):
+    if mode == 'interval':
+        return get_interval_symbols(line)
+    if mode == 'rhythm':
+        return get_rhythm_symbols(line)
+    return list(zip(get_interval_symbols(line), get_rhythm_symbols(line)))
+
+
+def build_suffix_array(sequence):
+    # Prefix doubling: after each round suffixes are ranked by their first 2k symbols, O(n log^2 n) worst case
+    # but repeated passes stop as soon as every rank is distinct
+    n = len(sequence)
+    if n == 0:
+        return []
+    ranks = {symbol: rank for rank, symbol in enumerate(sorted(set(sequence)))}
+    rank = [ranks[symbol] for symbol in sequence]
+    suffix_array = sorted(range(n), key=rank.__getitem__)
+
+    k = 1
+    while True:
+        keys = [rank[i] * (n + 1) + (rank[i + k] + 1 if i + k < n else 0) for i in range(n)]
+        suffix_array.sort(key=keys.__getitem__)
+        new_rank = [0] * n
+        current_rank = 0
+        for j in range(1, n):
+            if keys[suffix_array[j]] != keys[suffix_array[j - 1]]:
+                current_rank += 1
+            new_rank[suffix_array[j]] = current_rank
+        rank = new_rank
+        if current_rank == n - 1:
+            return suffix_array
+        k *= 2
+
+
+def build_lcp_array(sequence, suffix_array):
+    # Kasai: lcp[i] is the common prefix length of the suffixes at suffix_array[i - 1] and suffix_array[i]
+    n = len(sequence)
+    rank = [0] * n
+    for i, suffix in enumerate(suffix_array):
+        rank[suffix] = i
+
+    lcp = [0] * n
+    common = 0
+    for suffix in range(n):
+        if rank[suffix] == 0:
+            common = 0
+            continue
+        previous = suffix_array[rank[suffix] - 1]
+        while suffix + common < n and previous + common < n and sequence[suffix + common] == sequence[previous + common]:
+            common += 1
+        lcp[rank[suffix]] = common
+        if common:
+            common -= 1
+    return lcp
+
+
+def iter_maximal_repeats(sequence, suffix_array, lcp, min_length, max_length):
+    # (length, suffix array start, suffix array end) for every repeat that can't be extended to the right (an lcp
+    # interval) or to the left (the symbols before its occurrences differ). Repeats longer than max_length are
+    # reported once, cut down to max_length. A single stack pass over the lcp array, O(n) intervals.
+    n = len(sequence)
+    if n < 2:
+        return
+
+    def get_left_symbol(i):
+        # Position 0 has nothing to its left, which never matches anything
+        suffix = suffix_array[i]
+        return sequence[suffix - 1] if suffix > 0 else (None, 'start')
+
+    def merge(a, b):
+        # None marks an interval whose occurrences are already preceded by different symbols
+        return a if a == b else None
+
+    stack = [[0, 0, get_left_symbol(0)]]
+    for i in range(1, n + 1):
+        lcp_i = lcp[i] if i < n else 0
+        left = i - 1
+        child_symbol = get_left_symbol(i - 1)
+        while lcp_i < stack[-1][0]:
+            length, left, left_symbol = stack.pop()
+            parent_length = max(lcp_i, stack[-1][0])
+            if (left_symbol is None and length >= min_length and
+                    (length <= max_length or parent_length < max_length)):
+                yield min(length, max_length), left, i - 1
+            child_symbol = left_symbol
+            if lcp_i <= stack[-1][0]:
+                stack[-1][2] = merge(stack[-1][2], left_symbol)
+
+        if lcp_i > stack[-1][0]:
+            stack.append([lcp_i, left, merge(child_symbol, get_left_symbol(i))])
+        elif i < n:
+            stack[-1][2] = merge(stack[-1][2], get_left_symbol(i))
+
+
+def find_motifs(song, mode='interval', min_length=4, max_length=24, min_support=2, limit=None,
+                include_percussion=False):
+    # Repeated patterns within and across the channels of a song. Every channel's melody line becomes a symbol
+    # sequence (transposition invariant intervals, tempo invariant inter-onset ratios or both), the sequences are
+    # joined with unique separators and the maximal repeats fall out of one suffix array over all of them.
+    # Lengths count symbols: a pattern of n intervals covers n + 1 notes, n rhythm ratios cover n + 2.
+    # Motifs come back with their most covering ones first.
+    if mode not in MOTIF_MODES:
+        raise ValueError(f'Unknown motif mode {mode}, expected one of {", ".join(MOTIF_MODES)}')
+    extra_notes = 1 if mode == 'interval' else 2
+
+    alphabet = {}
+    sequence = []
+    line_starts = []
+    lines = []
+    for channel, line in sorted(get_melody_lines(song.notes, include_percussion).items()):
+        line_starts.append(len(sequence))
+        lines.append((channel, line))
+        sequence += [alphabet.setdefault(symbol, len(alphabet)) for symbol in get_symbols(line, mode)]
+        sequence.append(-1 - len(lines))  # Unique separator so no repeat runs from one line into the next
+
+    symbols = list(alphabet)
+    suffix_array = build_suffix_array(sequence)
+    lcp = build_lcp_array(sequence, suffix_array)
+
+    motifs = []
+    for length, start, end in iter_maximal_repeats(sequence, suffix_array, lcp, min_length, max_length):
+        positions = sorted(suffix_array[start:end + 1])
+        if len(positions) < min_support:
+            continue
+
+        # Overlapping occurrences of a self-similar pattern only count once
+        occurrences = []
+        next_free = -1
+        for position in positions:
+            if position < next_free:
+                continue
+            next_free = position + length
+            line_index = bisect_right(line_starts, position) - 1
+            channel, line = lines[line_index]
+            offset = position - line_starts[line_index]
+            occurrences.append(MotifOccurrence(channel, line[offset:offset + length + extra_notes]))
+        if len(occurrences) < min_support:
+            continue
+
+        pattern = tuple(symbols[symbol] for symbol in sequence[positions[0]:positions[0] + length])
+        motifs.append(Motif(pattern, sorted(occurrences, key=lambda occurrence: occurrence.start_tick)))
+
+    motifs.sort(key=lambda motif: (motif.support * len(motif.pattern), len(motif.pattern)), reverse=True)
+    return motifs if limit is None else motifs[:limit]
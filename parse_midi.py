@@ -1,9 +1,28 @@
+import heapq
+import logging
 import math
+import mmap
+import time
+import tracemalloc
+from bisect import bisect_left, bisect_right
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from array import array
+import sys
 from enum import Enum
+from functools import lru_cache
+from itertools import chain, groupby, islice
+from operator import itemgetter
 import binascii
 from fractions import Fraction
 
 
+# Bump whenever a change to the parser or analysis would change what a Song holds, cached songs key on it
+PARSER_VERSION = 3
+
+logger = logging.getLogger(__name__)
+
+
 def get_bytes(file_object, num_bytes):
     return int.from_bytes(file_object.read(num_bytes), "big")  # SMF are always big-endian
 
@@ -175,29 +194,38 @@ def key_lookup(key, mode):
     return keys.get(key, ["Unknown", "Unknown"])[mode]
 
 
-def pprint_table(table_data):
-    string_output = ""
-    col_widths = []
+def get_column_widths(table_data):
+    col_widths = [0] * len(table_data[0])
+    for row in table_data:
+        col_widths = [max(width, len(word)) for width, word in zip(col_widths, row)]
+    return [width + 2 for width in col_widths]
+
 
-    for col in range(len(table_data[0])):
-        current_column_max = 0
-        for row in range(len(table_data)):
-            current_column_max = max(len(table_data[row][col]), current_column_max)
-        col_widths.append(current_column_max + 2)
+def iter_table_lines(rows, col_widths=None, sample_size=None):
+    # Column widths are either given up front or taken from the first sample_size rows (all of them when None),
+    # so with fixed or sampled widths only the sample is ever held in memory
+    rows = iter(rows)
+    if col_widths is None:
+        sample = list(islice(rows, sample_size))
+        if not sample:
+            return
+        col_widths = get_column_widths(sample)
+        rows = chain(sample, rows)
 
-    for i, row in enumerate(table_data):
-        output = ""
-        for j, word in enumerate(row):
-            output += "".join(word.ljust(col_widths[j]))
-        string_output += output + "\n"
+    for i, row in enumerate(rows):
+        yield "".join([word.ljust(width) for word, width in zip(row, col_widths)]) + "\n"
 
         if i == 0:
-            spacer = ""
-            for width in col_widths:
-                spacer += "=" * width
-            string_output += spacer + "\n"
+            yield "".join(["=" * width for width in col_widths]) + "\n"
 
-    return string_output
+
+def write_table(rows, out, col_widths=None, sample_size=1000):
+    for line in iter_table_lines(rows, col_widths, sample_size):
+        out.write(line)
+
+
+def pprint_table(table_data):
+    return "".join(iter_table_lines(table_data))
 
 
 class Track:
@@ -207,27 +235,84 @@ class Track:
         self.label_events()
 
     def __str__(self):
-        track_print_data = [['Delta Time', 'MIDI Message', 'Event Type', 'Description of Event']]
+        return pprint_table(list(self.iter_rows()))
+
+    def iter_rows(self):
+        yield ['Delta Time', 'MIDI Message', 'Event Type', 'Description of Event']
         for event in self.events:
             event_string = str(event)
-            track_print_data.append(event_string.split('\t'))
+            yield event_string.split('\t')
 
-        string_output = pprint_table(track_print_data)
-        return string_output
+    def write(self, out, col_widths=None, sample_size=1000):
+        write_table(self.iter_rows(), out, col_widths, sample_size)
 
     def label_events(self):
         for event in self.events:
             event.track_id = self.id
 
 
+CHANNEL_EVENT_TYPES = {
+    0x8: 'Note Off',
+    0x9: 'Note On',
+    0xA: 'Aftertouch',
+    0xB: 'Control Change',
+    0xC: 'Patch Change',
+    0xD: 'Channel Pressure',
+    0xE: 'Pitch Bend',
+}
+
+META_EVENT_TYPES = {
+    0x00: 'Sequence Number',
+    0x01: 'Text Event',
+    0x02: 'Copyright Notice',
+    0x03: 'Sequence/Track Name',
+    0x04: 'Instrument Name',
+    0x05: 'Lyric Text',
+    0x06: 'Marker Text',
+    0x07: 'Cue Point',
+    0x20: 'MIDI Channel Prefix Assignment',
+    0x21: 'MIDI Port Assignment',
+    0x2F: 'End of Track',
+    0x51: 'Tempo Setting',
+    0x54: 'SMPTE Offset',
+    0x58: 'Time Signature',
+    0x59: 'Key Signature',
+    0x7F: 'Sequence Specific Event',
+}
+
+# Event type for every status byte, None where the meta type byte has to be consulted as well
+STATUS_EVENT_TYPES = [CHANNEL_EVENT_TYPES.get(status >> 4, 'Unsupported Event') for status in range(256)]
+STATUS_EVENT_TYPES[0xF0:0x100] = [None] * 16
+STATUS_EVENT_TYPES[0xF0] = 'System Exclusive Message'
+STATUS_EVENT_TYPES[0xF7] = 'System Exclusive Message'
+
+
+def get_event_type(status, data):
+    event_type = STATUS_EVENT_TYPES[status]
+    if event_type is None:
+        return META_EVENT_TYPES.get(data[0], 'Unrecognized Meta Message')
+    if status >> 4 == 0x9 and data[1] == 0:
+        return 'Note Off'
+    return event_type
+
+
+def get_payload_start(status, data):
+    # Meta data is the type, a variable length quantity length and the payload, sysex data the same minus the type
+    offset = 1 if status == 0xFF else 0
+    while data[offset] & 0x80:
+        offset += 1
+    return offset + 1
+
+
 class TrackEvent:
+    __slots__ = ['tick', 'command', 'data', 'event_type', 'track_id', '_event_description']
+
     def __init__(self, tick, command, data):
         self.tick = tick
         self.command = command
         self.data = data
-        self.event_type = ""
-        self.event_description = ""
-        self.populate_event_data()
+        self.event_type = get_event_type(command[0], data)
+        self._event_description = None
         self.track_id = -1
 
     def get_nibble(self):
@@ -236,7 +321,19 @@ class TrackEvent:
     def get_channel(self):
         return self.command[0] & 0x0F
 
-    def populate_event_data(self):
+    @property
+    def event_description(self):
+        # Only built when something actually prints the event
+        if self._event_description is None:
+            self._event_description = self.describe_event()
+        return self._event_description
+
+    @property
+    def payload(self):
+        # Meta or sysex payload without the type and length bytes
+        return self.data[get_payload_start(self.command[0], self.data):]
+
+    def describe_event(self):
         cmd_nib = self.get_nibble()
         chn_nib = self.get_channel()
 
@@ -249,105 +346,48 @@ class TrackEvent:
             key = get_note_name(self.data[0])
             octave = int(self.data[0] / 12) - 1
 
-        if cmd_nib == 0x8:
-            self.event_description = f'{key}{octave}: {self.data[1]}'
-            self.event_type = 'Note Off'
-            return
+        if cmd_nib == 0x8 or cmd_nib == 0xA:
+            return f'{key}{octave}: {self.data[1]}'
         if cmd_nib == 0x9:
-            self.event_description = f'{key}{octave}{"*" if perc else ""}: {self.data[1]}'
-            self.event_type = 'Note Off' if self.data[1] == 0 else 'Note On'
-            return
-        if cmd_nib == 0xA:
-            self.event_description = f'{key}{octave}: {self.data[1]}'
-            self.event_type = 'Aftertouch'
-            return
+            return f'{key}{octave}{"*" if perc else ""}: {self.data[1]}'
         if cmd_nib == 0xB:
-            self.event_description = f'Controller {self.data[0]}: {self.data[1]}'
-            self.event_type = 'Control Change'
-            return
+            return f'Controller {self.data[0]}: {self.data[1]}'
         if cmd_nib == 0xC:
-            self.event_description = f'Patch {self.data[0] + 1}: {patch_lookup(self.data[0])}'
-            self.event_type = 'Patch Change'
-            return
+            return f'Patch {self.data[0] + 1}: {patch_lookup(self.data[0])}'
         if cmd_nib == 0xD:
-            self.event_description = f'{self.data[0] + 1}'
-            self.event_type = 'Channel Pressure'
-            return
+            return f'{self.data[0] + 1}'
         if cmd_nib == 0xE:
-            self.event_description = f'{(self.data[0] & ((1 << 7) - 1)) << 7 | (self.data[1] & ((1 << 7) - 1))}'
             # TODO may be wrong idk or really care right now
-            self.event_type = 'Pitch Bend'
-            return
+            return f'{(self.data[0] & ((1 << 7) - 1)) << 7 | (self.data[1] & ((1 << 7) - 1))}'
         if cmd_nib == 0xF:
+            payload = self.payload
             if chn_nib == 0x0 or chn_nib == 0x7:
-                self.event_description = self.data[1:].decode().strip()
-                self.event_type = 'System Exclusive Message'
-                return
+                try:
+                    return payload.decode().strip()
+                except UnicodeError:
+                    return payload.hex(' ')
 
             meta_type = self.data[0]
-            try:
-                self.event_description = self.data[2:].decode('utf-8').strip()
-            except UnicodeError:
-                self.event_description = "Invalid UTF-8 String"
-            if meta_type == 0x00:
-                self.event_type = 'Sequence Number'
-                return
-            if meta_type == 0x01:
-                self.event_type = 'Text Event'
-                return
-            if meta_type == 0x02:
-                self.event_type = 'Copyright Notice'
-                return
-            if meta_type == 0x03:
-                self.event_type = 'Sequence/Track Name'
-                return
-            if meta_type == 0x04:
-                self.event_type = 'Instrument Name'
-                return
-            if meta_type == 0x05:
-                self.event_type = 'Lyric Text'
-                return
-            if meta_type == 0x06:
-                self.event_type = 'Marker Text'
-                return
-            if meta_type == 0x07:
-                self.event_type = 'Cue Point'
-                return
             if meta_type == 0x20:
-                self.event_description = f'Channel: {self.data[2]}'
-                self.event_type = 'MIDI Channel Prefix Assignment'
-                return
+                return f'Channel: {payload[0]}'
             if meta_type == 0x21:
-                self.event_description = f'Port: {self.data[2]}'
-                self.event_type = 'MIDI Port Assignment'
-                return
-            if meta_type == 0x2F:
-                self.event_type = 'End of Track'
-                return
+                return f'Port: {payload[0]}'
             if meta_type == 0x51:
-                self.event_description = f'Tempo: {self.data[2:]}'
-                self.event_type = 'Tempo Setting'
-                return
+                return f'Tempo: {payload}'
             if meta_type == 0x54:
-                self.event_description = f'{self.data[2]}:{self.data[3]}:{self.data[4]}:{self.data[5]}:{self.data[6]}'
-                self.event_type = 'SMPTE Offset'
-                return
+                return f'{payload[0]}:{payload[1]}:{payload[2]}:{payload[3]}:{payload[4]}'
             if meta_type == 0x58:
-                self.event_description = f'{self.data[2]}/{2 ** self.data[3]} '
-                self.event_description += f'({self.data[4]} ticks per click, '
-                self.event_description += f'{self.data[5]} 32nd-notes per quarter note)'
-                self.event_type = 'Time Signature'
-                return
+                description = f'{payload[0]}/{2 ** payload[1]} '
+                description += f'({payload[2]} ticks per click, '
+                description += f'{payload[3]} 32nd-notes per quarter note)'
+                return description
             if meta_type == 0x59:
-                self.event_description = f'{key_lookup(self.data[2], self.data[3])}'
-                self.event_type = 'Key Signature'
-                return
-            if meta_type == 0x7F:
-                self.event_type = 'Sequence Specific Event'
-                return
-            self.event_type = 'Unrecognized Meta Message'
-        self.event_type = 'Unsupported Event'
-        return
+                return f'{key_lookup(payload[0], payload[1])}'
+            try:
+                return payload.decode('utf-8').strip()
+            except UnicodeError:
+                return "Invalid UTF-8 String"
+        return ""
 
     def __str__(self):
         output_string = f'{self.tick}\t'
@@ -391,6 +431,20 @@ def get_variable_time(midi_file):
     return bytes_read, v_time
 
 
+def get_data_length(midi_file):
+    # Meta and sysex lengths are variable length quantities, returns their raw bytes (kept in the event data) and value
+    length_bytes = bytearray()
+    length = 0
+    while True:
+        byte = midi_file.read(1)
+        if not byte:
+            raise ValueError('Unexpected end of MIDI file')
+        length_bytes += byte
+        length = (length << 7) | (byte[0] & 0x7F)
+        if not byte[0] & 0x80:
+            return length_bytes, length
+
+
 def get_note_name(key):
     mod = key % 12
     if mod == 0:
@@ -419,11 +473,8 @@ def get_note_name(key):
         return "B"
 
 
-running_status = -1  # TODO can we cleanly make this not a global variable? Problem to solve later.
-
-
-def cleaner_event_parse(midi_file, use_running_status):
-    global running_status
+def cleaner_event_parse(midi_file, running_status=-1, use_running_status=False):
+    # Running status is passed in and handed back so each track (and thread) keeps its own
     command = running_status
     bytes_read = 0
     if not use_running_status:
@@ -445,67 +496,625 @@ def cleaner_event_parse(midi_file, use_running_status):
     elif cmd_nib == 0xF:
         if chn_nib == 0xF:
             meta_type = midi_file.read(1)
-            meta_length = midi_file.read(1)
-            meta_data = midi_file.read(meta_length[0])
-            data += bytearray(meta_type) + bytearray(meta_length) + bytearray(meta_data)
-            bytes_read += meta_length[0] + 2
+            length_bytes, meta_length = get_data_length(midi_file)
+            meta_data = midi_file.read(meta_length)
+            data += bytearray(meta_type) + length_bytes + bytearray(meta_data)
+            bytes_read += 1 + len(length_bytes) + meta_length
         elif chn_nib == 0x0 or chn_nib == 0x7:
-            sysex_bytes = midi_file.read(1)[0]
-            bytes_read += 1
-            midi_file.read(sysex_bytes)
-            bytes_read += sysex_bytes
+            length_bytes, sysex_length = get_data_length(midi_file)
+            sysex_data = midi_file.read(sysex_length)
+            data += length_bytes + bytearray(sysex_data)
+            bytes_read += len(length_bytes) + sysex_length
         else:
             raise ValueError(f'Bad command at byte {midi_file.tell() - 1}')
     else:
         if running_status != -1:
             midi_file.seek(-1, 1)
-            return cleaner_event_parse(midi_file, True)
+            return cleaner_event_parse(midi_file, running_status, True)
 
         raise ValueError(f'Bad command at byte {midi_file.tell() - 1}')
 
-    return bytes_read, command, data
+    return bytes_read, command, data, running_status
 
 
-def get_track_event(midi_file):
+def get_track_event(midi_file, running_status=-1):
     v_time_length, v_time = get_variable_time(midi_file)
-    event_length, command, data = cleaner_event_parse(midi_file, False)
+    event_length, command, data, running_status = cleaner_event_parse(midi_file, running_status)
 
-    return v_time_length + event_length, TrackEvent(v_time, command, data)
+    return v_time_length + event_length, TrackEvent(v_time, command, data), running_status
 
 
-def parse_track(midi_file):
+def parse_track(midi_file, buffered=True, track_id=-1):
     track_header = midi_file.read(4)
     if track_header != b'MTrk':
         raise ValueError('Invalid Track header')
 
     track_length = get_bytes(midi_file, 4)
+    if buffered:
+        # Pull the whole chunk in with one read and walk it by offset instead of reading byte by byte
+        return TrackParser(midi_file.read(track_length), track_id=track_id).parse()
+
     track_events = []
+    running_status = -1
     bytes_processed = 0
     while bytes_processed < track_length:
-        track_event_length, track_event = get_track_event(midi_file)
+        track_event_length, track_event, running_status = get_track_event(midi_file, running_status)
         bytes_processed += track_event_length
         track_events.append(track_event)
     return track_events
 
 
-def create_song():
-    with open('olors_Of_The_Wind.mid', 'rb') as f:
-        midi_format, num_track_chunks, division = parse_header(midi_file=f)
+STATUS_BYTES = [bytes([status]) for status in range(256)]
+
+
+class TruncatedEventError(ValueError):
+    # The bytes available so far end partway through an event
+    pass
+
+
+class EventFilter:
+    # Which events a parse keeps, decided from the status byte (and meta type) before anything is allocated.
+    # None means no restriction on that axis:
+    #   commands    channel message nibbles to keep, e.g. {0x8, 0x9} for notes only
+    #   channels    channels (0-15) to keep channel messages from
+    #   tracks      track ids to decode, other MTrk chunks are skipped whole using their header length
+    #   meta_types  meta types to keep, () drops every meta event. Keep 0x51 and 0x58 if you need tempo or meter
+    #   sysex       whether to keep sysex messages
+    # Skipped events still advance time, the next kept event's delta covers them so absolute ticks don't change.
+    def __init__(self, commands=None, channels=None, tracks=None, meta_types=None, sysex=True):
+        self.tracks = None if tracks is None else set(tracks)
+        self.meta_types = None if meta_types is None else set(meta_types)
+        self.keep_status = [False] * 256
+        for status in range(0x80, 0xF0):
+            self.keep_status[status] = ((commands is None or status >> 4 in commands) and
+                                        (channels is None or status & 0x0F in channels))
+        self.keep_status[0xF0] = self.keep_status[0xF7] = sysex
+        self.keep_status[0xFF] = self.meta_types is None or bool(self.meta_types)
+
+    def keep_track(self, track_id):
+        return self.tracks is None or track_id in self.tracks
+
+
+class TrackParser:
+    # Owns all of the decoding state for a single MTrk chunk, so any number of these can run side by side
+    def __init__(self, track_data, start=0, end=None, track_id=-1):
+        # track_data can be anything indexable by byte: bytes, bytearray, memoryview or an mmap of the whole file
+        self.track_data = track_data
+        self.start = start
+        self.end = len(track_data) if end is None else end
+        self.offset = start
+        self.track_id = track_id
+        self.running_status = -1
+        self.event_start = start
+
+    def error(self, message, error_type=ValueError):
+        return error_type(f'{message} at byte {self.event_start} (track {self.track_id}, '
+                          f'offset {self.event_start - self.start} into chunk)')
+
+    def read_variable_time(self):
+        track_data = self.track_data
+        offset = self.offset
+        v_time = 0
+        while True:
+            if offset >= self.end:
+                raise self.error('Truncated variable length quantity', TruncatedEventError)
+            byte = track_data[offset]
+            offset += 1
+            v_time = (v_time << 7) | (byte & 0x7F)
+            if not byte & 0x80:
+                self.offset = offset
+                return v_time
+
+    def read_data_length(self, offset):
+        # Meta and sysex lengths are variable length quantities too, returns (length, offset of the payload)
+        track_data = self.track_data
+        length = 0
+        while True:
+            if offset >= self.end:
+                raise self.error('Truncated event', TruncatedEventError)
+            byte = track_data[offset]
+            offset += 1
+            length = (length << 7) | (byte & 0x7F)
+            if not byte & 0x80:
+                return length, offset
+
+    def read_event(self):
+        v_time, status, data = self.read_raw_event()
+        return TrackEvent(v_time, STATUS_BYTES[status], data)
+
+    def read_raw_event(self):
+        # Parser state is only updated once the whole event is known to be there, so after a
+        # TruncatedEventError the parser can be rewound to event_start and retried with more data
+        self.event_start = self.offset
+        v_time = self.read_variable_time()
+
+        track_data = self.track_data
+        offset = self.offset
+        if offset >= self.end:
+            raise self.error('Truncated event', TruncatedEventError)
+        running_status = self.running_status
+        status = track_data[offset]
+        if status & 0x80:
+            offset += 1
+        elif running_status != -1:
+            status = running_status
+        else:
+            raise self.error('Bad command')
+
+        cmd_nib = status >> 4
+        chn_nib = status & 0x0F
+
+        if cmd_nib == 0xC or cmd_nib == 0xD:
+            data = bytearray(track_data[offset:offset + 1])
+            offset += 1
+            running_status = status
+        elif cmd_nib != 0xF:
+            data = bytearray(track_data[offset:offset + 2])
+            offset += 2
+            running_status = status
+        elif chn_nib == 0xF:
+            meta_length, payload_start = self.read_data_length(offset + 1)
+            data = bytearray(track_data[offset:payload_start + meta_length])
+            offset = payload_start + meta_length
+        elif chn_nib == 0x0 or chn_nib == 0x7:
+            # Sysex data is the length followed by the payload, kept so files can be written back unchanged
+            sysex_length, payload_start = self.read_data_length(offset)
+            data = bytearray(track_data[offset:payload_start + sysex_length])
+            offset = payload_start + sysex_length
+        else:
+            raise self.error('Bad command')
+
+        if offset > self.end:
+            raise self.error('Event runs past end of track', TruncatedEventError)
+        self.offset = offset
+        self.running_status = running_status
+        return v_time, status, data
+
+    def iter_filtered_events(self, event_filter):
+        # (absolute tick, delta since the last kept event, status, data) for the events event_filter keeps.
+        # Unwanted events are stepped over by their length without building anything for them.
+        track_data = self.track_data
+        end = self.end
+        keep_status = event_filter.keep_status
+        meta_types = event_filter.meta_types
+        offset = self.offset
+        running_status = self.running_status
+        current_tick = 0
+        last_kept_tick = 0
+        while offset < end:
+            self.event_start = offset
+            v_time = 0
+            while True:
+                if offset >= end:
+                    raise self.error('Truncated variable length quantity', TruncatedEventError)
+                byte = track_data[offset]
+                offset += 1
+                v_time = (v_time << 7) | (byte & 0x7F)
+                if not byte & 0x80:
+                    break
+            current_tick += v_time
+
+            if offset >= end:
+                raise self.error('Truncated event', TruncatedEventError)
+            status = track_data[offset]
+            if status & 0x80:
+                offset += 1
+            elif running_status != -1:
+                status = running_status
+            else:
+                raise self.error('Bad command')
+
+            if status < 0xF0:
+                running_status = status
+                length = 1 if status >> 4 == 0xC or status >> 4 == 0xD else 2
+            elif status == 0xFF:
+                data_length, payload_start = self.read_data_length(offset + 1)
+                length = payload_start + data_length - offset
+            elif status == 0xF0 or status == 0xF7:
+                data_length, payload_start = self.read_data_length(offset)
+                length = payload_start + data_length - offset
+            else:
+                raise self.error('Bad command')
+            if offset + length > end:
+                raise self.error('Event runs past end of track', TruncatedEventError)
+
+            if keep_status[status] and (status != 0xFF or meta_types is None or track_data[offset] in meta_types):
+                yield current_tick, current_tick - last_kept_tick, status, bytearray(track_data[offset:offset + length])
+                last_kept_tick = current_tick
+            offset += length
+            self.offset = offset
+            self.running_status = running_status
+
+    def iter_events(self, event_filter=None):
+        # Lazily decoded (absolute tick, event) pairs
+        if event_filter is not None:
+            for tick, delta, status, data in self.iter_filtered_events(event_filter):
+                yield tick, TrackEvent(delta, STATUS_BYTES[status], data)
+            return
+
+        current_tick = 0
+        while self.offset < self.end:
+            event = self.read_event()
+            current_tick += event.tick
+            yield current_tick, event
+
+    def parse(self, event_filter=None):
+        if event_filter is not None:
+            return [TrackEvent(delta, STATUS_BYTES[status], data)
+                    for _, delta, status, data in self.iter_filtered_events(event_filter)]
+
+        track_events = []
+        while self.offset < self.end:
+            track_events.append(self.read_event())
+        return track_events
+
 
-        if midi_format == Format.MULTI_SONG:
-            raise ValueError('Multi song midi not yet supported')
-        if midi_format > 2:
-            raise ValueError('Invalid midi format')
-        if bool(division & (1 << 15)):
-            raise ValueError('SMPTE Time Code not yet supported')
+STREAM_BLOCK_SIZE = 65536
 
-        tracks = [Track(parse_track(midi_file=f), i) for i in range(num_track_chunks)]
 
-        # for track in tracks:
-        #     print(track)
+def read_exactly(midi_file, num_bytes):
+    # Pipes and sockets can hand back less than was asked for
+    data = bytearray()
+    while len(data) < num_bytes:
+        block = midi_file.read(num_bytes - len(data))
+        if not block:
+            raise ValueError('Unexpected end of MIDI stream')
+        data += block
+    return bytes(data)
+
+
+def iter_stream_track(midi_file, track_length, track_id=-1, block_size=STREAM_BLOCK_SIZE):
+    # Decodes one MTrk body straight off a stream in blocks, yielding (absolute tick, event) as it goes.
+    # Only reads forward, so it works on pipes and sockets, and never holds more than a block or so
+    buffer = bytearray()
+    parser = TrackParser(buffer, track_id=track_id)
+    remaining = track_length
+    current_tick = 0
+    while True:
+        while parser.offset < parser.end:
+            try:
+                v_time, status, data = parser.read_raw_event()
+            except TruncatedEventError:
+                if remaining == 0:
+                    raise
+                parser.offset = parser.event_start
+                break
+            current_tick += v_time
+            yield current_tick, TrackEvent(v_time, STATUS_BYTES[status], data)
+
+        if remaining == 0:
+            return
+        del buffer[:parser.offset]
+        block = midi_file.read(min(block_size, remaining))
+        if not block:
+            raise ValueError('Unexpected end of MIDI stream')
+        buffer += block
+        remaining -= len(block)
+        parser.offset = 0
+        parser.end = len(buffer)
+
+
+def get_track_chunks(midi_data, num_track_chunks, offset=14):
+    # Returns the (start, end) of each MTrk body using the declared chunk lengths
+    chunks = []
+    for _ in range(num_track_chunks):
+        if midi_data[offset:offset + 4] != b'MTrk':
+            raise ValueError('Invalid Track header')
+        track_length = int.from_bytes(midi_data[offset + 4:offset + 8], "big")
+        if offset + 8 + track_length > len(midi_data):
+            raise ValueError(f'Track chunk at byte {offset} runs past the end of the file')
+        chunks.append((offset + 8, offset + 8 + track_length))
+        offset += 8 + track_length
+    return chunks
+
+
+def parse_header_data(midi_data):
+    if midi_data[0:4] != b'MThd':
+        raise ValueError('Invalid MIDI Header')
+
+    header_length = int.from_bytes(midi_data[4:8], "big")
+    if header_length != 6:
+        raise ValueError('Invalid header length')
+
+    return (int.from_bytes(midi_data[8:10], "big"),
+            int.from_bytes(midi_data[10:12], "big"),
+            int.from_bytes(midi_data[12:14], "big"))
+
+
+def parse_tracks(midi_data, num_track_chunks, event_filter=None):
+    # Tracks the filter leaves out come back empty so track ids stay the same, their bytes are never touched
+    tracks = []
+    for i, (start, end) in enumerate(get_track_chunks(midi_data, num_track_chunks)):
+        if event_filter is not None and not event_filter.keep_track(i):
+            tracks.append(Track([], i))
+        else:
+            tracks.append(Track(TrackParser(midi_data, start, end, i).parse(event_filter), i))
+    return tracks
+
+
+def parse_midi_data(midi_data, event_filter=None):
+    midi_format, num_track_chunks, division = parse_header_data(midi_data)
+    return midi_format, division, parse_tracks(midi_data, num_track_chunks, event_filter)
+
+
+def parse_midi_file(path, event_filter=None):
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as midi_data:
+            return parse_midi_data(midi_data, event_filter)
+
+
+class EventStore:
+    # Whole-song event storage as parallel arrays sorted by (tick, track), TrackEvents are only built on request
+    def __init__(self, num_tracks=0):
+        self.num_tracks = num_tracks
+        self.ticks = array('q')
+        self.deltas = array('I')
+        self.track_ids = array('H')
+        self.statuses = array('B')
+        self.data1 = array('B')
+        self.data2 = array('B')
+        self.meta_indices = array('q')  # Row in the meta table, -1 for channel events
+        # Meta table, one row per meta or sysex event: where its raw data (same layout as TrackEvent.data) starts in
+        # meta_data, and where its payload starts and how long it is
+        self.meta_starts = array('q')
+        self.payload_offsets = array('q')
+        self.payload_lengths = array('q')
+        self.meta_data = bytearray()
+
+    COLUMNS = ['ticks', 'deltas', 'track_ids', 'statuses', 'data1', 'data2', 'meta_indices']
+    META_COLUMNS = ['meta_starts', 'payload_offsets', 'payload_lengths']
+
+    def __len__(self):
+        return len(self.ticks)
+
+    def __getstate__(self):
+        # Columns can be read-only memoryviews over a cache file, those get copied into real arrays for pickling
+        state = self.__dict__.copy()
+        for name in self.COLUMNS + self.META_COLUMNS:
+            if isinstance(state[name], memoryview):
+                state[name] = array(state[name].format, state[name].tobytes())
+        if isinstance(state['meta_data'], memoryview):
+            state['meta_data'] = bytearray(state['meta_data'])
+        return state
+
+    def append(self, tick, delta, track_id, status, data):
+        self.ticks.append(tick)
+        self.deltas.append(delta)
+        self.track_ids.append(track_id)
+        self.statuses.append(status)
+        if status >= 0xF0:
+            self.data1.append(data[0] if status == 0xFF else 0)
+            self.data2.append(0)
+            self.meta_indices.append(len(self.meta_starts))
+            start = len(self.meta_data)
+            payload_start = get_payload_start(status, data)
+            self.meta_starts.append(start)
+            self.payload_offsets.append(start + payload_start)
+            self.payload_lengths.append(len(data) - payload_start)
+            self.meta_data += data
+        else:
+            self.data1.append(data[0] if len(data) > 0 else 0)
+            self.data2.append(data[1] if len(data) > 1 else 0)
+            self.meta_indices.append(-1)
+
+    def append_track(self, parser, event_filter=None):
+        # Decodes one track onto the end of the store, sort once every track is in
+        track_id = parser.track_id
+        if event_filter is not None:
+            for tick, delta, status, data in parser.iter_filtered_events(event_filter):
+                self.append(tick, delta, track_id, status, data)
+            return
+
+        current_tick = 0
+        while parser.offset < parser.end:
+            v_time, status, data = parser.read_raw_event()
+            current_tick += v_time
+            self.append(current_tick, v_time, track_id, status, data)
+
+    def extend(self, other):
+        # Appends the rows of another store, e.g. tracks decoded in other processes. Sort afterwards.
+        meta_base = len(self.meta_starts)
+        data_base = len(self.meta_data)
+        for name in ['ticks', 'deltas', 'track_ids', 'statuses', 'data1', 'data2']:
+            getattr(self, name).extend(getattr(other, name))
+        self.meta_indices.extend([row if row == -1 else row + meta_base for row in other.meta_indices])
+        self.meta_starts.extend([offset + data_base for offset in other.meta_starts])
+        self.payload_offsets.extend([offset + data_base for offset in other.payload_offsets])
+        self.payload_lengths.extend(other.payload_lengths)
+        self.meta_data += other.meta_data
+
+    def sort(self):
+        # Tracks are appended in order, so a stable sort on tick alone leaves ties ordered by (track, position)
+        order = sorted(range(len(self.ticks)), key=self.ticks.__getitem__)
+
+        for name in self.COLUMNS:
+            column = getattr(self, name)
+            setattr(self, name, array(column.typecode, [column[i] for i in order]))
+
+    def get_meta_span(self, i):
+        # (raw data start, payload start, payload end) in meta_data for a meta or sysex event
+        row = self.meta_indices[i]
+        payload_offset = self.payload_offsets[row]
+        return self.meta_starts[row], payload_offset, payload_offset + self.payload_lengths[row]
+
+    def get_payload(self, i):
+        _, payload_offset, end = self.get_meta_span(i)
+        return self.meta_data[payload_offset:end]
+
+    def get_data(self, i):
+        status = self.statuses[i]
+        cmd_nib = status >> 4
+        if cmd_nib == 0xF:
+            start, _, end = self.get_meta_span(i)
+            return bytearray(self.meta_data[start:end])
+        if cmd_nib == 0xC or cmd_nib == 0xD:
+            return bytearray([self.data1[i]])
+        return bytearray([self.data1[i], self.data2[i]])
+
+    def get_event(self, i):
+        event = TrackEvent(self.deltas[i], STATUS_BYTES[self.statuses[i]], self.get_data(i))
+        event.track_id = self.track_ids[i]
+        return event
+
+    def make_tracks(self):
+        track_events = [[] for _ in range(self.num_tracks)]
+        for i in range(len(self)):
+            track_events[self.track_ids[i]].append(self.get_event(i))
+        return [Track(events, track_id) for track_id, events in enumerate(track_events)]
+
+    @classmethod
+    def from_tracks(cls, tracks):
+        store = cls(len(tracks))
+        for track in tracks:
+            current_tick = 0
+            for event in track.events:
+                current_tick += event.tick
+                store.append(current_tick, event.tick, track.id, event.command[0], event.data)
+        store.sort()
+        return store
+
+    @classmethod
+    def from_midi_data(cls, midi_data, event_filter=None):
+        # Decodes straight into the arrays without building a TrackEvent per message
+        _, num_track_chunks, _ = parse_header_data(midi_data)
+        store = cls(num_track_chunks)
+        for i, (start, end) in enumerate(get_track_chunks(midi_data, num_track_chunks)):
+            if event_filter is None or event_filter.keep_track(i):
+                store.append_track(TrackParser(midi_data, start, end, i), event_filter)
+        store.sort()
+        return store
+
+
+class SongStats:
+    # Opt-in instrumentation for one song: wall and CPU time per stage, counters (events, notes, beats, bytes) and
+    # optionally peak traced allocation per stage. Every finished stage is also passed to callback (if given)
+    # and logged at DEBUG level.
+    def __init__(self, callback=None, trace_memory=False):
+        self.callback = callback
+        self.trace_memory = trace_memory
+        self.stages = {}  # name -> [calls, wall seconds, cpu seconds, peak bytes]
+        self.counters = {}
+        self.peak_stack = []
+
+    @contextmanager
+    def stage(self, name):
+        started_tracing = False
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                started_tracing = True
+            if self.peak_stack:
+                # Whatever the enclosing stage reached so far has to survive the reset
+                self.peak_stack[-1] = max(self.peak_stack[-1], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            self.peak_stack.append(0)
+
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield self
+        finally:
+            wall = time.perf_counter() - wall_start
+            cpu = time.process_time() - cpu_start
+            peak = 0
+            if self.trace_memory:
+                peak = max(self.peak_stack.pop(), tracemalloc.get_traced_memory()[1])
+                if self.peak_stack:
+                    self.peak_stack[-1] = max(self.peak_stack[-1], peak)
+                if started_tracing:
+                    tracemalloc.stop()
+
+            totals = self.stages.setdefault(name, [0, 0.0, 0.0, 0])
+            totals[0] += 1
+            totals[1] += wall
+            totals[2] += cpu
+            totals[3] = max(totals[3], peak)
+            logger.debug('%s: %.3f ms wall, %.3f ms cpu', name, wall * 1000, cpu * 1000)
+            if self.callback is not None:
+                self.callback(name, wall, cpu, peak)
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def as_dict(self):
+        return {
+            'stages': {name: {'calls': calls, 'wall': wall, 'cpu': cpu, 'peak_memory': peak}
+                       for name, (calls, wall, cpu, peak) in self.stages.items()},
+            'counters': dict(self.counters),
+        }
+
+    def __str__(self):
+        table = [['Stage', 'Calls', 'Wall (ms)', 'CPU (ms)', 'Peak (KiB)']]
+        for name, (calls, wall, cpu, peak) in self.stages.items():
+            table.append([name, str(calls), f'{wall * 1000:.3f}', f'{cpu * 1000:.3f}',
+                          f'{peak / 1024:.1f}' if self.trace_memory else '-'])
+        table.append(['' for _ in table[0]])
+        for name, value in self.counters.items():
+            table.append([name, str(value), '', '', ''])
+        return pprint_table(table)
+
 
-        new_song = Song(tracks, division)
-        print(new_song)
+class DisabledStats:
+    # Stand-in for SongStats when profiling is off, so instrumented code never has to check
+    NULL_STAGE = nullcontext()
+
+    def stage(self, name):
+        return self.NULL_STAGE
+
+    def count(self, name, amount=1):
+        pass
+
+    def as_dict(self):
+        return {'stages': {}, 'counters': {}}
+
+
+DISABLED_STATS = DisabledStats()
+
+
+def check_header(midi_format, division):
+    if midi_format == Format.MULTI_SONG.value:
+        raise ValueError('Multi song midi not yet supported')
+    if midi_format > 2:
+        raise ValueError('Invalid midi format')
+    if bool(division & (1 << 15)):
+        raise ValueError('SMPTE Time Code not yet supported')
+    if division == 0:
+        raise ValueError('Invalid division')
+
+
+def create_columnar_song(midi_data, note_policy='fifo', stats=None, event_filter=None):
+    stats = stats or DISABLED_STATS
+    with stats.stage('header'):
+        midi_format, _, division = parse_header_data(midi_data)
+        check_header(midi_format, division)
+    with stats.stage('decode'):
+        event_store = EventStore.from_midi_data(midi_data, event_filter)
+    stats.count('bytes', len(midi_data))
+    stats.count('events', len(event_store))
+    return Song(None, division, event_store, note_policy, stats)
+
+
+def create_song(path, columnar=False, stats=None, event_filter=None):
+    # Pass a SongStats as stats to time each stage, it stays available afterwards as song.stats.
+    # An EventFilter drops events and tracks in the decoder, before any objects get built for them.
+    stats = stats or DISABLED_STATS
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as midi_data:
+            if columnar:
+                return create_columnar_song(midi_data, stats=stats, event_filter=event_filter)
+
+            with stats.stage('header'):
+                midi_format, num_track_chunks, division = parse_header_data(midi_data)
+                check_header(midi_format, division)
+            with stats.stage('decode'):
+                tracks = parse_tracks(midi_data, num_track_chunks, event_filter)
+            stats.count('bytes', len(midi_data))
+            stats.count('events', sum(len(track.events) for track in tracks))
+
+    # for track in tracks:
+    #     print(track)
+
+    return Song(tracks, division, stats=stats)
 
 
 def get_perc_sound(key):
@@ -562,16 +1171,319 @@ def get_perc_sound(key):
     return perc_lookup.get(key, "Unknown Percussion")
 
 
+# How overlapping notes on the same channel and key are paired with their Note Offs:
+# 'fifo' releases the oldest open note first, 'lifo' the most recent one
+NOTE_PAIRING_POLICIES = ['fifo', 'lifo']
+
+
+class NotePairer:
+    # Open notes keyed by (channel, key), each key holding its notes oldest first
+    def __init__(self, note_policy='fifo'):
+        if note_policy not in NOTE_PAIRING_POLICIES:
+            raise ValueError('Invalid note pairing policy')
+        self.lifo = note_policy == 'lifo'
+        self.notes_on = {}
+
+    def note_on(self, note, track_id):
+        note_key = (note.channel, note.key)
+        if note_key not in self.notes_on:
+            self.notes_on[note_key] = deque()
+        self.notes_on[note_key].append((note, track_id))
+
+    def note_off(self, channel, key):
+        # The note this Note Off releases, or None if nothing was sounding on that key
+        open_notes = self.notes_on.get((channel, key))
+        if not open_notes:
+            return None
+        note, _ = open_notes.pop() if self.lifo else open_notes.popleft()
+        return note
+
+    def release_channel(self, channel):
+        # Every note sounding on a channel, e.g. for an All Notes Off
+        released = []
+        for (note_channel, _), open_notes in self.notes_on.items():
+            if note_channel == channel:
+                released += [note for note, _ in open_notes]
+                open_notes.clear()
+        return released
+
+    def iter_sounding(self):
+        for open_notes in self.notes_on.values():
+            for note, _ in open_notes:
+                yield note
+
+    def get_earliest_start(self):
+        starts = [open_notes[0][0].start_tick for open_notes in self.notes_on.values() if open_notes]
+        return min(starts) if starts else None
+
+    def close_all(self, track_ends, tempo_map):
+        # Anything never released rings until the end of its track
+        closed = []
+        for open_notes in self.notes_on.values():
+            for note, track_id in open_notes:
+                note.end_tick = track_ends[track_id]
+                note.end_time = tempo_map.tick_to_seconds(note.end_tick)
+                closed.append(note)
+            open_notes.clear()
+        return closed
+
+
+NOTE_NAMES = [f'{get_note_name(key)}{int(key / 12) - 1}' for key in range(128)]
+PERC_SOUNDS = [get_perc_sound(key) for key in range(128)]
+
+
 class Note:
-    def __init__(self, start_tick, channel, key, vel):
+    __slots__ = ['start_tick', 'end_tick', 'start_time', 'end_time', 'channel', 'perc', 'key', 'velocity']
+
+    def __init__(self, start_tick, channel, key, vel, start_time=0.0):
         self.start_tick = start_tick
         self.end_tick = start_tick
+        self.start_time = start_time  # Seconds, filled in from the song's TempoMap
+        self.end_time = start_time
         self.channel = channel
         self.perc = channel == 0x9
         self.key = key
         self.velocity = vel
-        self.perc_sound = get_perc_sound(key) if self.perc else ""
-        self.note_name = f'{get_note_name(key)}{int(key / 12) - 1}'
+
+    @property
+    def perc_sound(self):
+        return PERC_SOUNDS[self.key] if self.perc else ""
+
+    @property
+    def note_name(self):
+        return NOTE_NAMES[self.key]
+
+
+def make_notes(start_ticks, end_ticks, start_times, end_times, channels, keys, velocities):
+    # Notes from parallel columns, e.g. the ones in a song cache file
+    notes = []
+    for start_tick, end_tick, start_time, end_time, channel, key, velocity in zip(
+            start_ticks, end_ticks, start_times, end_times, channels, keys, velocities):
+        note = Note(start_tick, channel, key, velocity, start_time)
+        note.end_tick = end_tick
+        note.end_time = end_time
+        notes.append(note)
+    return notes
+
+
+DEFAULT_TEMPO = 500000  # Microseconds per quarter note until the first Tempo Setting (120 BPM)
+
+
+def iter_segments(segment_ticks, ticks):
+    # (tick, segment) for each tick, shared by the tempo and meter maps. Walks the segments forward while the ticks
+    # are ascending and only falls back to bisect when they go back.
+    segment = 0
+    last_segment = len(segment_ticks) - 1
+    for tick in ticks:
+        if tick < segment_ticks[segment]:
+            segment = max(bisect_right(segment_ticks, tick) - 1, 0)
+        while segment < last_segment and segment_ticks[segment + 1] <= tick:
+            segment += 1
+        yield tick, segment
+
+
+class TempoMap:
+    # One segment per tempo change: start tick, tempo, and microseconds elapsed before the segment starts
+    def __init__(self, division, tempo_events=()):
+        self.division = division
+        self.ticks = array('q', [0])
+        self.tempos = array('q', [DEFAULT_TEMPO])
+        self.offsets = array('d', [0.0])
+
+        for tick, tempo in tempo_events:
+            self.add_tempo(tick, tempo)
+
+    def add_tempo(self, tick, tempo):
+        # Tempo changes have to be added in tick order
+        if tick == self.ticks[-1]:
+            self.tempos[-1] = tempo
+            return
+        self.offsets.append(self.offsets[-1] + (tick - self.ticks[-1]) * self.tempos[-1] / self.division)
+        self.ticks.append(tick)
+        self.tempos.append(tempo)
+
+    def get_segment(self, tick):
+        return max(bisect_right(self.ticks, tick) - 1, 0)
+
+    def get_segment_seconds(self, segment, tick):
+        return (self.offsets[segment] + (tick - self.ticks[segment]) * self.tempos[segment] / self.division) / 1000000
+
+    def tick_to_seconds(self, tick):
+        return self.get_segment_seconds(self.get_segment(tick), tick)
+
+    def seconds_to_tick(self, seconds):
+        microseconds = seconds * 1000000
+        segment = max(bisect_right(self.offsets, microseconds) - 1, 0)
+        return self.ticks[segment] + (microseconds - self.offsets[segment]) * self.division / self.tempos[segment]
+
+    def ticks_to_seconds(self, ticks):
+        return array('d', [self.get_segment_seconds(segment, tick)
+                           for tick, segment in iter_segments(self.ticks, ticks)])
+
+    def seconds_to_ticks(self, seconds):
+        return array('d', [self.seconds_to_tick(second) for second in seconds])
+
+    def get_tempo(self, tick):
+        return self.tempos[self.get_segment(tick)]
+
+
+@lru_cache(maxsize=None)
+def get_beat_fraction(remainder, beat_ticks):
+    return Fraction(remainder, beat_ticks)
+
+
+MAX_DENOMINATOR_POWER = 6  # Down to 64th notes
+
+
+def get_time_signature(payload):
+    # (numerator, denominator power) from a Time Signature payload. A zero numerator or a huge denominator
+    # would make the measure grid step by nothing, so those are rejected rather than looped on forever.
+    if len(payload) < 2 or payload[0] == 0 or payload[1] > MAX_DENOMINATOR_POWER:
+        raise ValueError('Invalid time signature')
+    return payload[0], payload[1]
+
+
+class MeterMap:
+    # Built from the Time Signature events. Each segment starts a fresh measure at the tick the meter changes,
+    # positions inside a segment are kept scaled by the denominator so everything stays in integer math
+    def __init__(self, division, time_signatures=(), length=0):
+        self.division = division
+        self.segment_ticks = array('q', [0])
+        self.first_measures = array('q', [0])
+        self.numerators = array('q', [4])
+        self.denominator_powers = array('q', [2])
+
+        for tick, numerator, denominator_power in time_signatures:
+            if tick == self.segment_ticks[-1]:
+                self.numerators[-1] = numerator
+                self.denominator_powers[-1] = denominator_power
+                continue
+            measures = self.count_measures(len(self.segment_ticks) - 1, tick)
+            self.segment_ticks.append(tick)
+            self.first_measures.append(self.first_measures[-1] + measures)
+            self.numerators.append(numerator)
+            self.denominator_powers.append(denominator_power)
+
+        self.length = length
+        self.measure_starts = array('q', self.iter_grid_ticks(0))
+        self.beat_grids = {}
+
+    def count_measures(self, segment, tick):
+        # Number of measures (counting a partial last one) from the segment start up to tick
+        measure_ticks = self.numerators[segment] * self.division * 4
+        scaled = (tick - self.segment_ticks[segment]) << self.denominator_powers[segment]
+        return -(-scaled // measure_ticks)
+
+    def get_segment(self, tick):
+        return max(bisect_right(self.segment_ticks, tick) - 1, 0)
+
+    def get_position(self, tick, segment=None):
+        # (measure, beat, fraction of a beat) with measure and beat counted from 1
+        if segment is None:
+            segment = self.get_segment(tick)
+        beat_ticks = self.division * 4
+        scaled = (tick - self.segment_ticks[segment]) << self.denominator_powers[segment]
+        measure, position = divmod(scaled, self.numerators[segment] * beat_ticks)
+        beat, remainder = divmod(position, beat_ticks)
+        return self.first_measures[segment] + measure + 1, beat + 1, get_beat_fraction(remainder, beat_ticks)
+
+    def get_positions(self, ticks):
+        return [self.get_position(tick, segment) for tick, segment in iter_segments(self.segment_ticks, ticks)]
+
+    def get_measure(self, tick):
+        if 0 <= tick <= self.length:
+            return bisect_right(self.measure_starts, tick)
+        return self.get_position(tick)[0]
+
+    def get_measure_start(self, measure):
+        if 1 <= measure <= len(self.measure_starts):
+            return self.measure_starts[measure - 1]
+        raise ValueError('Measure out of range')
+
+    def iter_grid_ticks(self, subdivision):
+        # Measure starts when subdivision is 0, otherwise every beat split into subdivision parts, up to length
+        for segment, start in enumerate(self.segment_ticks):
+            end = self.segment_ticks[segment + 1] if segment + 1 < len(self.segment_ticks) else self.length + 1
+            denominator_power = self.denominator_powers[segment]
+            if subdivision == 0:
+                step = self.numerators[segment] * self.division * 4
+            else:
+                step = self.division * 4 // subdivision
+            scaled = 0
+            while True:
+                tick = start + (-(-scaled >> denominator_power))
+                if tick >= end:
+                    break
+                yield tick
+                scaled += step
+
+    def get_beat_grid(self, subdivision=1):
+        # Tick of every beat (or beat subdivision) in the song, cached per subdivision
+        if not 1 <= subdivision <= self.division * 4:
+            raise ValueError('Subdivision out of range')
+        if subdivision not in self.beat_grids:
+            self.beat_grids[subdivision] = array('q', self.iter_grid_ticks(subdivision))
+        return self.beat_grids[subdivision]
+
+
+class NoteIndex:
+    # Notes sorted by start tick, with a segment tree of max end ticks over them so a range query
+    # only descends into subtrees that can still hold an overlapping note: O(log n + k)
+    def __init__(self, notes, starts=None, max_ends=None):
+        # starts and max_ends can be passed in from an earlier build (e.g. a cache file) to skip building the tree
+        self.notes = notes
+        self.starts = [note.start_tick for note in notes] if starts is None else starts
+        self.size = 1
+        while self.size < len(notes):
+            self.size *= 2
+        if max_ends is not None:
+            self.max_ends = max_ends
+            return
+
+        self.max_ends = [-1] * (2 * self.size)
+        for i, note in enumerate(notes):
+            self.max_ends[self.size + i] = note.end_tick
+        for node in range(self.size - 1, 0, -1):
+            self.max_ends[node] = max(self.max_ends[2 * node], self.max_ends[2 * node + 1])
+
+    def query(self, start_tick, end_tick):
+        # Notes sounding somewhere in [start_tick, end_tick], in start order
+        in_range = []
+        if start_tick > end_tick:
+            return in_range
+
+        last = bisect_right(self.starts, end_tick)
+        stack = [(1, 0, self.size)]
+        while stack:
+            node, lo, hi = stack.pop()
+            if lo >= last or self.max_ends[node] <= start_tick:
+                continue
+            if node >= self.size:
+                in_range.append(self.notes[node - self.size])
+                continue
+            mid = (lo + hi) // 2
+            stack.append((2 * node + 1, mid, hi))
+            stack.append((2 * node, lo, mid))
+        return in_range
+
+    def sweep(self, start_tick, window_size, stop_tick):
+        # Sweep-line walk over consecutive windows, yields (window_start, notes) with the same
+        # results as query(window_start, window_start + window_size - 1) for each window
+        active = []
+        next_note = bisect_left(self.starts, start_tick)
+        if next_note > 0:
+            active = self.query(start_tick, start_tick)
+            active = [note for note in active if note.start_tick < start_tick]
+
+        current_tick = start_tick
+        while current_tick < stop_tick:
+            window_end = current_tick + window_size - 1
+            while next_note < len(self.notes) and self.starts[next_note] <= window_end:
+                active.append(self.notes[next_note])
+                next_note += 1
+            active = [note for note in active if note.end_tick > current_tick]
+            yield current_tick, list(active)
+            current_tick += window_size
 
 
 def create_chord_vector(combined_octaves):
@@ -598,16 +1510,21 @@ def create_chord_vector(combined_octaves):
     return chord_vector
 
 
-def parse_chord(actual_notes):
+def get_chord_vector(actual_notes):
     # Weight each note based on its presence (length)
-    weight_sum = sum(note.end_tick - note.start_tick for note in actual_notes)
+    durations = [note.end_tick - note.start_tick for note in actual_notes]
+    weight_sum = sum(durations)
+    if weight_sum == 0:
+        # Nothing but zero length notes, count them all the same
+        durations = [1 for _ in actual_notes]
+        weight_sum = len(actual_notes)
     # TODO these modifiers aren't really good because they can't easily be set to have no effect
     VELOCITY_MOD = 0.25  # How much should velocity affect the weight of a note?
     ROOT_MOD = 2  # How much should being root note affect the weight of a note?
     weighted_notes = sorted([
         {
             'note': note,
-            'weight': ((note.end_tick - note.start_tick) / weight_sum) *
+            'weight': (durations[i] / weight_sum) *
                       (VELOCITY_MOD * note.velocity) *
                       (ROOT_MOD if i == 0 else 1)
         } for i, note in enumerate(actual_notes)
@@ -626,139 +1543,355 @@ def parse_chord(actual_notes):
     for note in combined_octaves:
         combined_octaves[note] /= weight_sum
 
-    chord_vector = create_chord_vector(combined_octaves)
-    closest_chords = match_chord_vector(chord_vector)
+    return create_chord_vector(combined_octaves)
 
-    output = ", ".join(chord.name for chord in closest_chords[:2])
-    return output
 
+def make_chroma(notes, beat_size, num_beats, start_tick=0, velocity_weight=1.0, root_weight=2, clip=True,
+                normalize=True):
+    # (num_beats x 12) pitch class weights as one flat row-major array, row b covering the beat starting at
+    # start_tick + b * beat_size. Each note is visited once and adds to every beat it overlaps, instead of a
+    # chord vector being rebuilt from note names for every beat.
+    #   velocity_weight  exponent on velocity, 0 ignores velocity
+    #   root_weight      multiplier for the lowest note of each beat, 1 ignores it
+    #   clip             weigh notes by how much of them is inside the beat, not by their whole length
+    # With clip=False and the defaults, rows match get_chord_vector for the same notes.
+    NOTES_IN_OCTAVE = 12
+    chroma = array('d', bytes(8 * NOTES_IN_OCTAVE * num_beats))
+    presence = [0] * num_beats
+    zero_length_weights = {}  # Beats where every note has zero length fall back to velocity alone
+    root_keys = [128] * num_beats
+    root_pitch_classes = [0] * num_beats
+    root_levels = [0.0] * num_beats
+    root_overlaps = [0] * num_beats
+
+    for note in notes:
+        if note.channel == 0x9:
+            continue
+        start = note.start_tick
+        end = note.end_tick
+        key = note.key
+        pitch_class = key % NOTES_IN_OCTAVE
+        duration = end - start
+        level = note.velocity ** velocity_weight
+        # Same overlap rule as NoteIndex.sweep: end_tick > beat start and start_tick < beat end
+        first_beat = max((start - start_tick) // beat_size, 0)
+        last_beat = min((end - 1 - start_tick) // beat_size, num_beats - 1)
+        for beat in range(first_beat, last_beat + 1):
+            overlap = duration
+            if clip:
+                beat_start = start_tick + beat * beat_size
+                overlap = min(end, beat_start + beat_size) - max(start, beat_start)
+            chroma[beat * NOTES_IN_OCTAVE + pitch_class] += overlap * level
+            presence[beat] += overlap
+            if duration == 0:
+                weights = zero_length_weights.setdefault(beat, [0.0] * NOTES_IN_OCTAVE)
+                weights[pitch_class] += level
+            if key < root_keys[beat]:
+                root_keys[beat] = key
+                root_pitch_classes[beat] = pitch_class
+                root_levels[beat] = level
+                root_overlaps[beat] = overlap
+
+    for beat in range(num_beats):
+        if root_keys[beat] == 128:
+            continue
+        row_start = beat * NOTES_IN_OCTAVE
+        if presence[beat] == 0:
+            chroma[row_start:row_start + NOTES_IN_OCTAVE] = array('d', zero_length_weights[beat])
+            root_extra = root_levels[beat]
+        else:
+            root_extra = root_overlaps[beat] * root_levels[beat]
+        chroma[row_start + root_pitch_classes[beat]] += (root_weight - 1) * root_extra
 
-class Song:
-    def __init__(self, tracks, division):
-        self.tracks = tracks
-        self.division = division
-        self.event_stream = self.make_event_stream()
-        self.notes = self.parse_notes()
-        self.channels = self.get_channels()
-        self.length = self.get_length()
+        if normalize:
+            total = sum(chroma[row_start:row_start + NOTES_IN_OCTAVE])
+            if total:
+                for i in range(row_start, row_start + NOTES_IN_OCTAVE):
+                    chroma[i] /= total
+    return chroma
 
-    def parse_notes(self):
-        notes = []
 
-        notes_on = []  # TODO could be hashed but I can't be bothered
+def iter_chroma_rows(chroma):
+    NOTES_IN_OCTAVE = 12
+    for row_start in range(0, len(chroma), NOTES_IN_OCTAVE):
+        yield chroma[row_start:row_start + NOTES_IN_OCTAVE]
 
-        ticks = sorted(self.event_stream.keys())
 
-        for tick in ticks:
-            events = self.event_stream[tick]
-            for event in events:
-                channel = event.get_channel()
+def parse_chord(actual_notes):
+    closest_chords = match_chord_vector(get_chord_vector(actual_notes), limit=2)
 
-                if event.event_type == "Note On":
-                    key = event.data[0]
-                    vel = event.data[1]
-                    notes_on.append(Note(tick, channel, key, vel))
+    output = ", ".join(chord.name for chord in closest_chords)
+    return output
 
-                if event.event_type == "Note Off":
-                    key = event.data[0]
-                    for note in notes_on:
-                        if note.channel == channel and note.key == key:
-                            note.end_tick = tick
-                            notes.append(note)
-                            notes_on.remove(note)
 
-        return sorted(notes, key=lambda n: n.start_tick)
+def label_chords(note_groups):
+    chord_vectors = [get_chord_vector(actual_notes) for actual_notes in note_groups]
+    return [", ".join(chord.name for chord in closest_chords)
+            for closest_chords in match_chord_vectors(chord_vectors, limit=2)]
 
-    def get_channels(self):
-        channels = set()
-        ticks = sorted(self.event_stream.keys())
 
-        for tick in ticks:
-            events = self.event_stream[tick]
-            for event in events:
-                if event.get_nibble() != 0xF:
-                    channels.add(event.get_channel())
-        return list(channels)
+def label_chroma(chroma):
+    # Chord labels for every row of a make_chroma matrix. Rows can differ from get_chord_vector in the last bit,
+    # which is enough to flip between chords at exactly the same distance, so Song output keeps its own path.
+    NOTES_IN_OCTAVE = 12
+    chord_vectors = [chroma[i:i + NOTES_IN_OCTAVE].tolist() for i in range(0, len(chroma), NOTES_IN_OCTAVE)]
+    return [", ".join(chord.name for chord in closest_chords)
+            for closest_chords in match_chord_vectors(chord_vectors, limit=2)]
 
-    def get_notes_in_range(self, start_tick, end_tick):
-        in_range = []
-        if start_tick > end_tick:
-            return in_range
 
-        for note in self.notes:
-            start = note.start_tick
-            end = note.end_tick
+def iter_track_events(track):
+    # (absolute tick, event) for one track
+    current_tick = 0
+    for event in track.events:
+        current_tick += event.tick
+        yield current_tick, event
 
-            if end > start_tick and start <= end_tick:
-                in_range.append(note)
 
-        return in_range
+class Song:
+    def __init__(self, tracks, division, event_store=None, note_policy='fifo', stats=None):
+        self._tracks = tracks
+        self.division = division
+        self.event_store = event_store
+        self.note_policy = note_policy
+        self.stats = stats or DISABLED_STATS
+        self._merged_events = None
+        self._event_stream = None
+        self._note_columns = None
+        self._note_tree = None
+        with self.stats.stage('scan_events'):
+            self._notes, self.channels, self.length, self.tempo_map, time_signatures = self.scan_events()
+        self.stats.count('notes', len(self._notes))
+        with self.stats.stage('note_index'):
+            self._note_index = NoteIndex(self._notes)
+        with self.stats.stage('meter_map'):
+            self.meter_map = MeterMap(division, time_signatures, self.length)
+
+    @classmethod
+    def restore(cls, division, event_store, note_policy, note_columns, channels, length, tempo_map, meter_map,
+                note_tree=None):
+        # Rebuilds a columnar Song from already computed parts (e.g. a cache hit) without scanning the events.
+        # note_columns are the make_notes arguments, Note objects and the NoteIndex (from note_tree, its max_ends,
+        # when given) are only built once something asks for them.
+        song = cls.__new__(cls)
+        song._tracks = None
+        song.division = division
+        song.event_store = event_store
+        song.note_policy = note_policy
+        song.stats = DISABLED_STATS
+        song._merged_events = None
+        song._event_stream = None
+        song._notes = None
+        song._note_index = None
+        song._note_columns = note_columns
+        song._note_tree = note_tree
+        song.channels = channels
+        song.length = length
+        song.tempo_map = tempo_map
+        song.meter_map = meter_map
+        return song
+
+    def __getstate__(self):
+        # Restored note columns can be memoryviews over a cache file, those get copied into real arrays for pickling
+        state = self.__dict__.copy()
+        if state['_note_columns'] is not None:
+            state['_note_columns'] = [array(column.format, column.tobytes()) if isinstance(column, memoryview)
+                                      else column for column in state['_note_columns']]
+        if isinstance(state['_note_tree'], memoryview):
+            state['_note_tree'] = array(state['_note_tree'].format, state['_note_tree'].tobytes())
+        # The index can hold the same memoryviews, it's rebuilt lazily from the copied columns
+        state['_note_index'] = None
+        return state
+
+    @property
+    def notes(self):
+        if self._notes is None:
+            self._notes = make_notes(*self._note_columns)
+        return self._notes
+
+    @property
+    def note_index(self):
+        if self._note_index is None:
+            starts = self._note_columns[0] if self._note_columns is not None else None
+            self._note_index = NoteIndex(self.notes, starts, self._note_tree)
+        return self._note_index
+
+    @property
+    def tracks(self):
+        if self._tracks is None:
+            self._tracks = self.event_store.make_tracks()
+        return self._tracks
+
+    def iter_events(self):
+        # Lazy (tick, event) stream. The tracks are k-way merged by absolute tick and heapq.merge keeps
+        # equal ticks in track order, the same order the old tick -> events dict had
+        if self.event_store is not None:
+            return ((tick, self.event_store.get_event(i)) for i, tick in enumerate(self.event_store.ticks))
+        return heapq.merge(*[iter_track_events(track) for track in self.tracks], key=itemgetter(0))
+
+    @property
+    def merged_events(self):
+        # The merged stream as a list, built once
+        if self._merged_events is None:
+            self._merged_events = list(self.iter_events())
+        return self._merged_events
+
+    @property
+    def event_stream(self):
+        if self._event_stream is None:
+            self._event_stream = self.make_event_stream()
+        return self._event_stream
+
+    def get_messages(self):
+        # (tick, track_id, status, data1, data2) for every event in stream order
+        if self.event_store is not None:
+            store = self.event_store
+            return zip(store.ticks, store.track_ids, store.statuses, store.data1, store.data2)
+
+        return ((tick, event.track_id, event.command[0], event.data[0] if len(event.data) > 0 else 0,
+                 event.data[1] if len(event.data) > 1 else 0)
+                for tick, event in self.merged_events)
+
+    def get_meta_payload(self, i):
+        # Payload of the i-th event in stream order, which has to be a meta event
+        if self.event_store is not None:
+            return self.event_store.get_payload(i)
+        return self.merged_events[i][1].payload
+
+    def get_meta_events(self, meta_type):
+        # (tick, payload) for every meta event of one type in stream order
+        for i, (tick, _, status, data1, _) in enumerate(self.get_messages()):
+            if status == 0xFF and data1 == meta_type:
+                yield tick, self.get_meta_payload(i)
+
+    def scan_events(self):
+        # Notes, channels, length, tempo map and time signatures all come out of one pass over the stream
+        note_pairer = NotePairer(self.note_policy)
+        notes = []
+        track_ends = {}
+        channels = set()
+        tempo_map = TempoMap(self.division)
+        time_signatures = []
+        length = 0
+
+        for i, (tick, track_id, status, key, vel) in enumerate(self.get_messages()):
+            track_ends[track_id] = tick
+            length = tick
+            cmd_nib = status >> 4
+            if cmd_nib == 0xF:
+                # Tempo changes only affect ticks after them, so adding them as they come keeps note times right
+                if status == 0xFF and key == 0x51:
+                    tempo_map.add_tempo(tick, int.from_bytes(self.get_meta_payload(i)[0:3], "big"))
+                elif status == 0xFF and key == 0x58:
+                    time_signatures.append((tick, *get_time_signature(self.get_meta_payload(i))))
+                continue
+
+            channel = status & 0x0F
+            channels.add(channel)
+            if cmd_nib == 0x9 and vel != 0:
+                note_pairer.note_on(Note(tick, channel, key, vel, tempo_map.tick_to_seconds(tick)), track_id)
+            elif cmd_nib == 0x8 or cmd_nib == 0x9:
+                # Note Off, or Note On with velocity 0
+                note = note_pairer.note_off(channel, key)
+                if note is not None:
+                    note.end_tick = tick
+                    note.end_time = tempo_map.tick_to_seconds(tick)
+                    notes.append(note)
+
+        notes += note_pairer.close_all(track_ends, tempo_map)
+        notes = sorted(notes, key=lambda n: n.start_tick)
+        return notes, list(channels), length, tempo_map, time_signatures
+
+    def parse_notes(self):
+        return self.scan_events()[0]
+
+    def get_channels(self):
+        return self.scan_events()[1]
+
+    def get_notes_in_range(self, start_tick, end_tick):
+        return self.note_index.query(start_tick, end_tick)
+
+    def iter_notes_by_window(self, window_size, start_tick=0, stop_tick=None):
+        if stop_tick is None:
+            stop_tick = self.length + window_size
+        return self.note_index.sweep(start_tick, window_size, stop_tick)
 
     def make_event_stream(self):
         event_stream = {}
-        for track in self.tracks:
-            current_tick = 0
-            for event in track.events:
-                tick = event.tick + current_tick
-                if tick not in event_stream:
-                    event_stream[tick] = []
-                event_stream[tick].append(event)
-                current_tick = tick
+        with self.stats.stage('make_event_stream'):
+            for tick, events in self.iter_event_groups():
+                event_stream[tick] = events
         return event_stream
 
-    def get_event_stream_printout(self):
-        song_data = [['Tick', 'Measure', 'Beat']]
-        HEADER_DATA = len(song_data[0])
-        for track in self.tracks:
-            song_data[0].append(f'Track {track.id}')
-
-        ticks = sorted(self.event_stream.keys())
-
-        for tick in ticks:
-            events = [['' for _ in song_data[0]]]
+    def get_track_ids(self):
+        if self._tracks is None:
+            return list(range(self.event_store.num_tracks))
+        return [track.id for track in self.tracks]
+
+    def iter_event_groups(self):
+        # (tick, events) in stream order
+        events = self.merged_events if self._merged_events is not None else self.iter_events()
+        for tick, tick_events in groupby(events, key=itemgetter(0)):
+            yield tick, [event for _, event in tick_events]
+
+    def iter_event_stream_rows(self):
+        header = ['Tick', 'Measure', 'Beat']
+        HEADER_DATA = len(header)
+        for track_id in self.get_track_ids():
+            header.append(f'Track {track_id}')
+        yield header
+
+        for tick, tick_events in self.iter_event_groups():
+            events = [['' for _ in header]]
             events[0][0] = str(tick)
             events[0][1] = str(self.get_measure(tick))
             events[0][2] = str(self.get_beat(tick))
 
-            for event in self.event_stream[tick]:
+            for event in tick_events:
                 event_list = 0
 
                 while events[event_list][event.track_id + HEADER_DATA] != '':
                     event_list += 1
                     if event_list >= len(events):
-                        events.append(['' for _ in song_data[0]])
+                        events.append(['' for _ in header])
 
                 events[event_list][event.track_id + HEADER_DATA] += f'{event.event_type} {event.event_description}'
 
-            for event_list in events:
-                song_data.append(event_list)
+            yield from events
+
+    def get_event_stream_printout(self):
+        with self.stats.stage('render_event_stream'):
+            return pprint_table(list(self.iter_event_stream_rows()))
 
-        return pprint_table(song_data)
+    def write_event_stream(self, out, col_widths=None, sample_size=1000):
+        with self.stats.stage('render_event_stream'):
+            write_table(self.iter_event_stream_rows(), out, col_widths, sample_size)
 
     def get_measure(self, tick):
-        # TODO account for different time signatures
-        time_signature_numerator = 4
-        return int(tick / (self.division * time_signature_numerator)) + 1
+        return self.meter_map.get_measure(tick)
 
     def get_beat(self, tick):
-        # TODO account for different time signatures
-        time_signature_numerator = 4
-        beat_number = int((tick % (self.division * time_signature_numerator)) / self.division) + 1
-        beat_fraction = Fraction(
-            (tick % (self.division * time_signature_numerator)) / self.division + 1).limit_denominator() - beat_number
+        _, beat_number, beat_fraction = self.meter_map.get_position(tick)
         return f'{beat_number} {beat_fraction}'
 
     def __str__(self):
-        song_data = [['Tick', 'Measure', 'Beat', 'Notes', 'Chord']]
-        HEADER_DATA = len(song_data[0])
+        # Chord matching happens row by row while rendering, so it's timed as part of render
+        with self.stats.stage('render'):
+            return pprint_table(list(self.iter_beat_rows()))
+
+    def write(self, out, col_widths=None, sample_size=1000):
+        with self.stats.stage('render'):
+            write_table(self.iter_beat_rows(), out, col_widths, sample_size)
+
+    def iter_beat_rows(self):
+        header = ['Tick', 'Measure', 'Beat', 'Notes', 'Chord']
+        HEADER_DATA = len(header)
         for channel in self.channels:
-            song_data[0].append(f'Channel {channel + 1}')
+            header.append(f'Channel {channel + 1}')
+        yield header
 
-        current_tick = 0
         beat_size = self.division  # TODO account for different time signatures
-        while current_tick < (self.length + beat_size):
-            beat = ['' for _ in song_data[0]]
-            notes = self.get_notes_in_range(current_tick, current_tick + beat_size - 1)
+        for current_tick, notes in self.iter_notes_by_window(beat_size):
+            beat = ['' for _ in header]
             beat[0] = str(int(current_tick))
             beat[1] = str(self.get_measure(current_tick))
             beat[2] = str(self.get_beat(current_tick))
@@ -777,14 +1910,37 @@ class Song:
                     beat[3] += note_name
 
             beat[4] = parse_chord(actual_notes)
-            current_tick += beat_size
-            song_data.append(beat)
-
-        return pprint_table(song_data)
+            self.stats.count('beats')
+            yield beat
+
+    def get_chord_labels(self, beat_size=None):
+        # Chord label for every beat of the song in one call, as (tick, label) pairs
+        if beat_size is None:
+            beat_size = self.division
+        ticks = []
+        note_groups = []
+        with self.stats.stage('chord_labels'):
+            for current_tick, notes in self.iter_notes_by_window(beat_size):
+                ticks.append(current_tick)
+                note_groups.append([n for n in sorted(notes, key=lambda x: x.key) if n.channel != 0x9])
+            labels = label_chords(note_groups)
+        self.stats.count('beats', len(ticks))
+        return list(zip(ticks, labels))
+
+    def get_chroma(self, beat_size=None, velocity_weight=1.0, root_weight=2, clip=True, normalize=True):
+        # (beat ticks, flat beats x 12 chroma) over the same beats as get_chord_labels. The chroma is a
+        # row-major array('d'), so numpy.frombuffer(chroma).reshape(-1, 12) views it without a copy
+        if beat_size is None:
+            beat_size = self.division
+        ticks = array('q', range(0, self.length + beat_size, beat_size))
+        with self.stats.stage('chroma'):
+            chroma = make_chroma(self.notes, beat_size, len(ticks), 0, velocity_weight, root_weight, clip,
+                                 normalize)
+        self.stats.count('beats', len(ticks))
+        return ticks, chroma
 
     def get_length(self):
-        ticks = sorted(self.event_stream.keys(), reverse=True)
-        return ticks[0]
+        return self.scan_events()[2]
 
 
 class Chord:
@@ -797,59 +1953,297 @@ class Chord:
         return math.sqrt(sum((self.vector[i] - other.vector[i]) ** 2 for i in range(12)))
 
 
-def match_chord_vector(chord_vector):
+# Multiplier for the weight of the root note,
+# will be semi-normalized so it will become less potent as you add notes to the chord
+TEMPLATE_ROOT_MOD = 1.5
+
+CHORD_TEMPLATES = [
+    [[0, 7], "5"],
+    [[0, 4, 7], ""],
+    [[0, 3, 7], "m"],
+    [[0, 4, 8], "+"],
+    [[0, 2, 7], "sus2"],
+    [[0, 5, 7], "sus"],
+    [[0, 4, 7, 9], "6"],
+    [[0, 4, 7, 10], "7"],
+    [[0, 4, 7, 11], "maj7"],
+    [[0, 3, 7, 10], "m7"],
+    [[0, 4, 7, 14], "add9"],
+]
+
+# Not in the default library, register them with register_chord_template if you want them
+EXTENDED_CHORD_TEMPLATES = [
+    [[0, 3, 6], "dim"],
+    [[0, 3, 6, 9], "dim7"],
+    [[0, 3, 6, 10], "m7b5"],
+    [[0, 3, 7, 9], "m6"],
+    [[0, 3, 7, 11], "mMaj7"],
+    [[0, 4, 8, 10], "+7"],
+    [[0, 5, 7, 10], "7sus"],
+    [[0, 3, 7, 14], "madd9"],
+    [[0, 4, 7, 10, 14], "9"],
+    [[0, 4, 7, 11, 14], "maj9"],
+    [[0, 3, 7, 10, 14], "m9"],
+    [[0, 4, 7, 10, 13], "7b9"],
+    [[0, 4, 7, 10, 15], "7#9"],
+    [[0, 4, 7, 10, 14, 17], "11"],
+    [[0, 3, 7, 10, 14, 17], "m11"],
+    [[0, 4, 7, 10, 14, 18], "9#11"],
+    [[0, 4, 7, 10, 14, 21], "13"],
+    [[0, 4, 7, 11, 14, 21], "maj13"],
+    [[0, 3, 7, 10, 14, 21], "m13"],
+]
+
+
+MATCH_CACHE_SIZE = 4096
+
+
+def get_pitch_class_mask(vector):
+    mask = 0
+    for pitch_class, weight in enumerate(vector):
+        if weight:
+            mask |= 1 << pitch_class
+    return mask
+
+
+def make_template_chord(root, intervals, name, root_weight, bass=0):
+    # Intervals are reduced mod 12, so 14 and 2 both mean a 9th. The bass interval gets the root weighting,
+    # bass=0 is the plain root position chord and anything else is named as a slash chord
+    chord_name = f'{get_note_name(root)}{name}'
+    if bass % 12 != 0:
+        chord_name += f'/{get_note_name(root + bass)}'
+
+    new_chord = Chord([], chord_name)
+    for step in intervals:
+        idx = (root + step) % 12
+        new_chord.vector[idx] = 1 / len(intervals)
+        if step % 12 == bass % 12:
+            new_chord.vector[idx] *= root_weight
+
+    # "Normalize"
+    new_chord.vector = [x / sum(new_chord.vector) for x in new_chord.vector]
+    return new_chord
+
+
+class ChordTreeNode:
+    # Bounding box of the chord vectors below it. zero_distance is the squared distance from the all-zero vector
+    # to the box, which the search corrects for just the sounding pitch classes.
+    __slots__ = ['lows', 'highs', 'zero_distance', 'indices', 'children']
+
+    def __init__(self, vectors, indices):
+        self.lows = [min(vectors[i][pitch_class] for i in indices) for pitch_class in range(12)]
+        self.highs = [max(vectors[i][pitch_class] for i in indices) for pitch_class in range(12)]
+        self.zero_distance = sum(low * low for low in self.lows)
+        self.indices = indices
+        self.children = ()
+
+    def get_distance(self, sounding):
+        # Lower bound on the squared distance from an input (its (pitch class, weight) pairs) to any chord below
+        distance = self.zero_distance
+        for pitch_class, weight in sounding:
+            low = self.lows[pitch_class]
+            distance -= low * low
+            if weight < low:
+                distance += (low - weight) ** 2
+            elif weight > self.highs[pitch_class]:
+                distance += (weight - self.highs[pitch_class]) ** 2
+        return distance
+
+
+def build_chord_tree(vectors, indices, leaf_size=8):
+    # k-d tree split on whichever pitch class varies most, leaves hold up to leaf_size chord indices
+    node = ChordTreeNode(vectors, indices)
+    if len(indices) > leaf_size:
+        split = max(range(12), key=lambda pitch_class: node.highs[pitch_class] - node.lows[pitch_class])
+        indices = sorted(indices, key=lambda i: vectors[i][split])
+        middle = len(indices) // 2
+        node.children = (build_chord_tree(vectors, indices[:middle], leaf_size),
+                         build_chord_tree(vectors, indices[middle:], leaf_size))
+        node.indices = None
+    return node
+
+
+class ChordLibrary:
+    # The chord library compiled into a 12 x N column matrix (one column list per pitch class) plus squared norms,
+    # so matching is a handful of list-wide multiply-adds instead of building and comparing Chord objects.
+    # Registering a template only appends its 12 transpositions, nothing already compiled is rebuilt.
+    # Nearest chord searches (a limit, which is what labeling uses) go through a k-d tree over the chord vectors
+    # instead, which only gets built on the first search after the library changes.
+    def __init__(self, templates=()):
+        self.chords = []
+        self.columns = [[] for _ in range(12)]
+        self.norms = []
+        self.pitch_class_index = {}  # Pitch class bitmask -> indices of chords using exactly those pitch classes
+        self.tree = None
+        self.match_cache = {}  # Beats repeat a lot in real songs, so identical chroma vectors are only matched once
+        for template in templates:
+            self.register_template(*template)
+
+    def add_chord(self, chord):
+        self.match_cache.clear()
+        self.tree = None
+        self.pitch_class_index.setdefault(get_pitch_class_mask(chord.vector), []).append(len(self.chords))
+        self.chords.append(chord)
+        for pitch_class in range(12):
+            self.columns[pitch_class].append(chord.vector[pitch_class])
+        self.norms.append(sum(x * x for x in chord.vector))
+
+    def register_template(self, intervals, name, root_weight=TEMPLATE_ROOT_MOD, bass=0):
+        for root in range(12):
+            self.add_chord(make_template_chord(root, intervals, name, root_weight, bass))
+
+    def register_inversions(self, intervals, name, root_weight=TEMPLATE_ROOT_MOD):
+        # Slash chord voicings with each non-root chord tone in the bass
+        for bass in intervals:
+            if bass % 12 != 0:
+                self.register_template(intervals, name, root_weight, bass)
+
+    def match_exact(self, input_chord, threshold):
+        indices = self.pitch_class_index.get(get_pitch_class_mask(input_chord.vector), [])
+        distances = [(input_chord.distance(self.chords[i]), i) for i in indices]
+        return [distance for distance in distances if distance[0] <= threshold]
+
+    def match(self, chord_vector, threshold=0.5, limit=None, exact_first=False):
+        cache_key = (tuple(chord_vector), threshold, limit, exact_first)
+        if cache_key in self.match_cache:
+            return list(self.match_cache[cache_key])
+
+        input_chord = Chord(chord_vector, "Unnamed")
+
+        # Chords built from exactly the sounding pitch classes skip the distance search entirely
+        distances = self.match_exact(input_chord, threshold) if exact_first else []
+        if distances and limit is not None:
+            distances = heapq.nsmallest(limit, distances)
+        elif limit is not None:
+            distances = self.match_nearest(input_chord, threshold, limit)
+        else:
+            if not distances:
+                distances = self.match_distance(input_chord, threshold)
+            distances.sort()
+
+        close_chords = [self.chords[i] for _, i in distances]
+        if len(self.match_cache) >= MATCH_CACHE_SIZE:
+            self.match_cache.clear()
+        self.match_cache[cache_key] = close_chords
+        return list(close_chords)
+
+    def match_distance(self, input_chord, threshold):
+        input_norm = sum(x * x for x in input_chord.vector)
+
+        # Only the pitch classes that are actually sounding contribute to the dot products
+        dots = [0.0] * len(self.chords)
+        for pitch_class, weight in enumerate(input_chord.vector):
+            if weight:
+                dots = [dot + weight * x for dot, x in zip(dots, self.columns[pitch_class])]
+
+        # |a - b|^2 = |a|^2 + |b|^2 - 2a.b is a cheap filter, the few survivors get their exact distance
+        # so the ordering (and ties) come out the same as comparing every chord directly
+        cutoff = threshold * threshold + 1e-9
+        distances = [(input_chord.distance(self.chords[i]), i)
+                     for i, (norm, dot) in enumerate(zip(self.norms, dots)) if input_norm + norm - 2 * dot <= cutoff]
+        return [distance for distance in distances if distance[0] <= threshold]
+
+    def match_nearest(self, input_chord, threshold, limit):
+        # The limit closest (distance, index) pairs within threshold, closest first, the same as taking the
+        # smallest limit of match_distance. Tree nodes come off a heap nearest box first, and the search stops
+        # once the nearest box left is further than the limit-th best chord so far, so a match only looks at the
+        # few leaves around the input however big the library is.
+        if self.tree is None:
+            self.tree = build_chord_tree([chord.vector for chord in self.chords], list(range(len(self.chords))))
+        vector = input_chord.vector
+        input_norm = sum(x * x for x in vector)
+        sounding = [(pitch_class, weight) for pitch_class, weight in enumerate(vector) if weight]
+        columns = self.columns
+        norms = self.norms
+
+        cutoff = threshold * threshold + 1e-9
+        best = []  # Max heap of the best (distance, index) so far, stored negated
+        nodes = [(0.0, 0, self.tree)]
+        node_count = 1
+        while nodes:
+            box_distance, _, node = heapq.heappop(nodes)
+            if box_distance > cutoff:
+                break
+            if node.indices is None:
+                for child in node.children:
+                    heapq.heappush(nodes, (child.get_distance(sounding), node_count, child))
+                    node_count += 1
+                continue
+
+            for i in node.indices:
+                dot = sum(weight * columns[pitch_class][i] for pitch_class, weight in sounding)
+                if input_norm + norms[i] - 2 * dot > cutoff:
+                    continue
+                # Exact distances from here, so the ordering (and ties) match comparing every chord directly
+                distance = input_chord.distance(self.chords[i])
+                if distance > threshold:
+                    continue
+                if len(best) < limit:
+                    heapq.heappush(best, (-distance, -i))
+                elif (-distance, -i) > best[0]:
+                    heapq.heapreplace(best, (-distance, -i))
+                if len(best) == limit:
+                    cutoff = min(cutoff, best[0][0] * best[0][0] + 1e-9)
+        return sorted((-distance, -i) for distance, i in best)
+
+
+@lru_cache(maxsize=None)
+def get_chord_library():
+    return ChordLibrary(CHORD_TEMPLATES)
+
+
+def register_chord_template(intervals, name, root_weight=TEMPLATE_ROOT_MOD, bass=0):
+    get_chord_library().register_template(intervals, name, root_weight, bass)
+
+
+def match_chord_vector(chord_vector, limit=None, exact_first=False):
     # TODO consider key signature?
-    input_chord = Chord(chord_vector, "Unnamed")
-
-    chord_library = generate_chord_library()
+    DISTANCE_THRESHOLD = 0.5
+    return get_chord_library().match(chord_vector, DISTANCE_THRESHOLD, limit, exact_first)
 
-    # Compute distance to each chord in library
-    distances = [[input_chord.distance(chord), chord] for chord in chord_library]
-    distances = sorted(distances, key=lambda chord: chord[0])
 
+def match_chord_vectors(chord_vectors, limit=None, exact_first=False):
+    chord_library = get_chord_library()
     DISTANCE_THRESHOLD = 0.5
-    close_chords = [chord[1] for chord in distances if chord[0] <= DISTANCE_THRESHOLD]
-
-    return close_chords
+    return [chord_library.match(chord_vector, DISTANCE_THRESHOLD, limit, exact_first) for chord_vector in chord_vectors]
 
 
 def generate_chord_library():
-    library = []
-
-    # Multiplier for the weight of the root note,
-    # will be semi-normalized so it will become less potent as you add notes to the chord
-    ROOT_MOD = 1.5
-
-    chord_templates = [
-        [[0, 7], "5"],
-        [[0, 4, 7], ""],
-        [[0, 3, 7], "m"],
-        [[0, 4, 8], "+"],
-        [[0, 2, 7], "sus2"],
-        [[0, 5, 7], "sus"],
-        [[0, 4, 7, 9], "6"],
-        [[0, 4, 7, 10], "7"],
-        [[0, 4, 7, 11], "maj7"],
-        [[0, 3, 7, 10], "m7"],
-        [[0, 4, 7, 14], "add9"],
-    ]
-
-    for template in chord_templates:
-        steps = template[0]
-        name = template[1]
-        for i in range(12):
-            new_chord = Chord([], f'{get_note_name(i)}{name}')
-            for step in steps:
-                idx = (i + step) % 12
-                new_chord.vector[idx] = 1 / len(steps)
-                if step == 0:
-                    new_chord.vector[idx] *= ROOT_MOD
-
-            # "Normalize"
-            new_chord.vector = [x / sum(new_chord.vector) for x in new_chord.vector]
-            library.append(new_chord)
-    return library
+    return ChordLibrary(CHORD_TEMPLATES).chords
+
+
+def profile_song(path, output=None, sort='cumulative', limit=30, columnar=False):
+    # cProfile capture of loading and printing one song, saved to output for pstats/snakeviz or printed
+    import cProfile
+    import pstats
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    str(create_song(path, columnar))
+    profiler.disable()
+    if output is not None:
+        profiler.dump_stats(output)
+    pstats.Stats(profiler, stream=sys.stderr).sort_stats(sort).print_stats(limit)
 
 
 if __name__ == "__main__":
-    create_song()
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Print the beat by beat breakdown of a MIDI file')
+    parser.add_argument('path', nargs='?', default='Twinkle.mid')
+    parser.add_argument('--columnar', action='store_true', help='use the columnar event store')
+    parser.add_argument('--stats', action='store_true', help='print per-stage timings and counters to stderr')
+    parser.add_argument('--trace-memory', action='store_true', help='with --stats, also track peak allocation')
+    parser.add_argument('--profile', nargs='?', const='', metavar='OUTPUT',
+                        help='run under cProfile instead, optionally saving the capture to OUTPUT')
+    parser.add_argument('--sort', default='cumulative', help='pstats sort key for --profile')
+    args = parser.parse_args()
+
+    if args.profile is not None:
+        profile_song(args.path, args.profile or None, args.sort, columnar=args.columnar)
+    else:
+        song_stats = SongStats(trace_memory=args.trace_memory) if args.stats or args.trace_memory else None
+        song = create_song(args.path, args.columnar, song_stats)
+        print(song)
+        if song_stats is not None:
+            print(song_stats, file=sys.stderr)
@@ -0,0 +1,252 @@
+import asyncio
+import json
+import os
+import struct
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from parse_midi import create_columnar_song, get_chord_library
+
+# Every frame in either direction is (request id, kind, payload length) followed by the payload.
+# Requests: ANALYZE with MIDI file bytes, or METRICS with no payload. Responses carry JSON under the same id
+# and come back as soon as they're done, so they can arrive out of order.
+FRAME_HEADER = struct.Struct('>IBI')
+ANALYZE = ord('a')
+METRICS = ord('m')
+RESULT = ord('r')
+ERROR = ord('e')
+MAX_REQUEST_SIZE = 64 << 20
+LATENCY_WINDOW = 1000  # Recent requests kept for the latency percentiles
+
+
+def warm_worker():
+    # Runs once per worker process so the first request doesn't pay for building the chord library
+    get_chord_library()
+
+
+def analyze_midi_data(midi_data):
+    song = create_columnar_song(midi_data)
+    return {
+        'division': song.division,
+        'length': song.length,
+        'seconds': song.tempo_map.tick_to_seconds(song.length),
+        'channels': sorted(song.channels),
+        'num_events': len(song.event_store),
+        'num_notes': len(song.notes),
+        'chords': song.get_chord_labels(),
+    }
+
+
+class ServiceMetrics:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.queued = 0  # Accepted but not sent to a worker yet
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+
+    def get_percentile(self, latencies, fraction):
+        return latencies[min(int(len(latencies) * fraction), len(latencies) - 1)] if latencies else 0.0
+
+    def as_dict(self):
+        latencies = sorted(self.latencies)
+        uptime = time.monotonic() - self.started
+        return {
+            'uptime': uptime,
+            'queue_depth': self.queued,
+            'running': self.running,
+            'completed': self.completed,
+            'failed': self.failed,
+            'requests_per_second': (self.completed + self.failed) / uptime if uptime else 0.0,
+            'latency_p50': self.get_percentile(latencies, 0.5),
+            'latency_p95': self.get_percentile(latencies, 0.95),
+            'latency_max': latencies[-1] if latencies else 0.0,
+        }
+
+
+class AnalysisService:
+    # Requests from every connection share one warm process pool. At most max_pending requests are in flight;
+    # past that a connection stops being read until something finishes, so clients feel the backpressure
+    # through the socket instead of the queue growing without bound.
+    def __init__(self, max_workers=None, max_pending=None):
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        if max_pending is None:
+            max_pending = max_workers * 4
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.executor = None
+        self.pending = None
+        self.workers_free = None
+        self.metrics = ServiceMetrics()
+
+    async def start(self):
+        self.executor = ProcessPoolExecutor(max_workers=self.max_workers, initializer=warm_worker)
+        self.pending = asyncio.Semaphore(self.max_pending)
+        self.workers_free = asyncio.Semaphore(self.max_workers)
+        # Start every worker now rather than on the first burst of requests
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(self.executor, warm_worker) for _ in range(self.max_workers)])
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+
+    async def analyze(self, midi_data):
+        # Waits for a free worker first, so queue_depth counts what's really waiting rather than what the
+        # executor has buffered
+        loop = asyncio.get_running_loop()
+        self.metrics.queued += 1
+        try:
+            # Cancelled here if the client goes away while waiting, the count has to come back down either way
+            await self.workers_free.acquire()
+        finally:
+            self.metrics.queued -= 1
+        self.metrics.running += 1
+        try:
+            return await loop.run_in_executor(self.executor, analyze_midi_data, midi_data)
+        finally:
+            self.metrics.running -= 1
+            self.workers_free.release()
+
+    async def handle_request(self, request_id, midi_data, send):
+        start = time.monotonic()
+        try:
+            result = await self.analyze(midi_data)
+        except Exception as e:
+            # Anything a bad file makes the parser throw goes back to the client rather than killing the connection
+            self.metrics.failed += 1
+            await send(request_id, ERROR, {'error': str(e)})
+        else:
+            self.metrics.completed += 1
+            await send(request_id, RESULT, result)
+        finally:
+            self.metrics.latencies.append(time.monotonic() - start)
+            self.pending.release()
+
+    async def handle_connection(self, reader, writer):
+        write_lock = asyncio.Lock()
+        tasks = set()
+
+        async def send(request_id, kind, payload):
+            payload = json.dumps(payload).encode()
+            async with write_lock:
+                writer.write(FRAME_HEADER.pack(request_id, kind, len(payload)) + payload)
+                await writer.drain()
+
+        try:
+            while True:
+                try:
+                    request_id, kind, length = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+                except asyncio.IncompleteReadError:
+                    break
+                if length > MAX_REQUEST_SIZE:
+                    await send(request_id, ERROR, {'error': f'Request of {length} bytes is too large'})
+                    break
+                payload = await reader.readexactly(length)
+
+                if kind == METRICS:
+                    await send(request_id, RESULT, self.metrics.as_dict())
+                elif kind == ANALYZE:
+                    await self.pending.acquire()
+                    task = asyncio.create_task(self.handle_request(request_id, payload, send))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                else:
+                    await send(request_id, ERROR, {'error': f'Unknown request kind {kind}'})
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            for task in tasks:
+                task.cancel()
+        finally:
+            writer.close()
+
+    async def serve(self, socket_path=None, host='127.0.0.1', port=0):
+        # A Unix socket when socket_path is given, otherwise TCP on localhost
+        await self.start()
+        if socket_path is not None:
+            return await asyncio.start_unix_server(self.handle_connection, socket_path)
+        return await asyncio.start_server(self.handle_connection, host, port)
+
+
+class AnalysisClient:
+    # Pipelines requests over one connection and matches responses back up by request id
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.next_id = 0
+        self.waiting = {}
+        self.receiver = asyncio.create_task(self.receive())
+
+    @classmethod
+    async def connect(cls, socket_path=None, host='127.0.0.1', port=None):
+        if socket_path is not None:
+            reader, writer = await asyncio.open_unix_connection(socket_path)
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer)
+
+    async def receive(self):
+        try:
+            while True:
+                request_id, kind, length = FRAME_HEADER.unpack(await self.reader.readexactly(FRAME_HEADER.size))
+                payload = json.loads(await self.reader.readexactly(length))
+                future = self.waiting.pop(request_id)
+                if kind == ERROR:
+                    future.set_exception(ValueError(payload['error']))
+                else:
+                    future.set_result(payload)
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            for future in self.waiting.values():
+                future.set_exception(ConnectionError(f'Connection closed: {e}'))
+            self.waiting.clear()
+
+    async def request(self, kind, payload=b''):
+        request_id = self.next_id
+        self.next_id = (self.next_id + 1) & 0xFFFFFFFF
+        future = asyncio.get_running_loop().create_future()
+        self.waiting[request_id] = future
+        self.writer.write(FRAME_HEADER.pack(request_id, kind, len(payload)) + payload)
+        await self.writer.drain()
+        return await future
+
+    async def analyze(self, midi_data):
+        return await self.request(ANALYZE, midi_data)
+
+    async def get_metrics(self):
+        return await self.request(METRICS)
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+        self.receiver.cancel()
+
+
+async def run_service(socket_path=None, host='127.0.0.1', port=8765, max_workers=None, max_pending=None):
+    service = AnalysisService(max_workers, max_pending)
+    server = await service.serve(socket_path, host, port)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        service.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Local MIDI analysis service')
+    parser.add_argument('--socket', help='listen on this Unix socket instead of TCP')
+    parser.add_argument('--port', type=int, default=8765, help='TCP port on 127.0.0.1')
+    parser.add_argument('--workers', type=int, help='worker processes (default one per core)')
+    parser.add_argument('--max-pending', type=int, help='requests in flight before reads pause (default 4 per worker)')
+    args = parser.parse_args()
+    try:
+        asyncio.run(run_service(args.socket, port=args.port, max_workers=args.workers, max_pending=args.max_pending))
+    except KeyboardInterrupt:
+        sys.exit(0)
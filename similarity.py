@@ -0,0 +1,202 @@
+import hashlib
+import heapq
+import math
+import os
+import random
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
+
+from file_utils import pack_header, read_header, write_file_atomically
+from midi_cache import load_cached_song
+from motifs import get_interval_symbols, get_melody_lines
+from parse_midi import create_song
+
+INDEX_MAGIC = b'MOTIFIDX'
+INDEX_FORMAT_VERSION = 1
+MINHASH_PRIME = (1 << 61) - 1
+HISTOGRAM_WEIGHT = 0.25  # Share of the score that comes from pitch class histograms instead of shared n-grams
+
+
+class Fingerprint:
+    # What a song is compared by: a set of chord label and interval n-gram tokens plus a pitch class histogram
+    def __init__(self, tokens, histogram):
+        self.tokens = tokens
+        self.histogram = histogram
+
+
+def get_pitch_class_histogram(notes):
+    # Duration weighted and scaled to unit length, so the dot product of two histograms is their cosine similarity
+    NOTES_IN_OCTAVE = 12
+    histogram = [0.0] * NOTES_IN_OCTAVE
+    for note in notes:
+        if note.channel != 0x9:
+            histogram[note.key % NOTES_IN_OCTAVE] += max(note.end_tick - note.start_tick, 1)
+    norm = math.sqrt(sum(weight * weight for weight in histogram))
+    return [weight / norm for weight in histogram] if norm else histogram
+
+
+def get_ngrams(symbols, n):
+    return [','.join(str(symbol) for symbol in symbols[i:i + n]) for i in range(len(symbols) - n + 1)]
+
+
+def get_fingerprint(song, chord_ngram=3, interval_ngram=4):
+    # Chord progressions are taken as changes, so a chord held for several beats reads the same as a short one
+    chords = []
+    for _, label in song.get_chord_labels():
+        chord = label.split(', ')[0] or 'N'
+        if not chords or chords[-1] != chord:
+            chords.append(chord)
+    tokens = {f'c:{ngram}' for ngram in get_ngrams(chords, chord_ngram)}
+
+    for line in get_melody_lines(song.notes).values():
+        tokens.update(f'i:{ngram}' for ngram in get_ngrams(get_interval_symbols(line), interval_ngram))
+    return Fingerprint(tokens, get_pitch_class_histogram(song.notes))
+
+
+@lru_cache(maxsize=None)
+def get_permutations(num_perm, seed):
+    rng = random.Random(seed)
+    return [(rng.randrange(1, MINHASH_PRIME), rng.randrange(0, MINHASH_PRIME)) for _ in range(num_perm)]
+
+
+def get_token_hash(token):
+    return int.from_bytes(hashlib.blake2b(token.encode(), digest_size=8).digest(), "little") % MINHASH_PRIME
+
+
+def get_signature(tokens, num_perm=128, seed=1):
+    # MinHash: the fraction of equal slots between two signatures estimates the Jaccard similarity of the token sets
+    hashes = [get_token_hash(token) for token in tokens]
+    if not hashes:
+        return array('Q', [MINHASH_PRIME] * num_perm)
+    return array('Q', [min((a * h + b) % MINHASH_PRIME for h in hashes) for a, b in get_permutations(num_perm, seed)])
+
+
+def get_file_entry(path, num_perm=128, seed=1, cache_dir=None):
+    # Worker entry point, returns (path, signature, histogram) or None for files that can't be parsed.
+    # Malformed files can fail anywhere in decoding, and one of them mustn't abort a whole index build.
+    try:
+        song = create_song(path) if cache_dir is None else load_cached_song(path, cache_dir)
+    except Exception:
+        return None
+    fingerprint = get_fingerprint(song)
+    return path, get_signature(fingerprint.tokens, num_perm, seed), array('d', fingerprint.histogram)
+
+
+class SimilarityIndex:
+    # MinHash signatures banded into LSH buckets: songs sharing every row of any band become candidates, and only
+    # candidates get scored. With 32 bands of 4 rows, pairs above ~0.5 Jaccard collide with high probability
+    # while unrelated songs almost never do, so a query touches a handful of buckets instead of every song.
+    def __init__(self, num_perm=128, bands=32, seed=1):
+        if num_perm % bands:
+            raise ValueError('num_perm has to be a multiple of bands')
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.seed = seed
+        self.signatures = {}
+        self.histograms = {}
+        self.buckets = [{} for _ in range(bands)]
+
+    def __len__(self):
+        return len(self.signatures)
+
+    def __contains__(self, song_id):
+        return song_id in self.signatures
+
+    def iter_band_keys(self, signature):
+        for band in range(self.bands):
+            yield band, tuple(signature[band * self.rows:(band + 1) * self.rows])
+
+    def add_entry(self, song_id, signature, histogram):
+        if song_id in self.signatures:
+            self.remove(song_id)
+        self.signatures[song_id] = signature
+        self.histograms[song_id] = histogram
+        for band, key in self.iter_band_keys(signature):
+            self.buckets[band].setdefault(key, set()).add(song_id)
+
+    def add(self, song_id, fingerprint):
+        self.add_entry(song_id, get_signature(fingerprint.tokens, self.num_perm, self.seed),
+                       array('d', fingerprint.histogram))
+
+    def remove(self, song_id):
+        signature = self.signatures.pop(song_id)
+        del self.histograms[song_id]
+        for band, key in self.iter_band_keys(signature):
+            bucket = self.buckets[band][key]
+            bucket.discard(song_id)
+            if not bucket:
+                del self.buckets[band][key]
+
+    def get_candidates(self, signature):
+        candidates = set()
+        for band, key in self.iter_band_keys(signature):
+            candidates.update(self.buckets[band].get(key, ()))
+        return candidates
+
+    def get_score(self, signature, histogram, song_id):
+        other_signature = self.signatures[song_id]
+        jaccard = sum(a == b for a, b in zip(signature, other_signature)) / self.num_perm
+        cosine = sum(a * b for a, b in zip(histogram, self.histograms[song_id]))
+        return (1 - HISTOGRAM_WEIGHT) * jaccard + HISTOGRAM_WEIGHT * cosine
+
+    def query_entry(self, signature, histogram, k=10, exclude=None, exhaustive=False):
+        candidates = self.signatures.keys() if exhaustive else self.get_candidates(signature)
+        return heapq.nlargest(k, ((self.get_score(signature, histogram, song_id), song_id)
+                                  for song_id in candidates if song_id != exclude))
+
+    def query(self, fingerprint, k=10, exclude=None, exhaustive=False):
+        # Top k (score, song id) pairs, best first. exhaustive scores every song instead of just LSH candidates.
+        return self.query_entry(get_signature(fingerprint.tokens, self.num_perm, self.seed),
+                                fingerprint.histogram, k, exclude, exhaustive)
+
+    def query_song(self, song_id, k=10, exhaustive=False):
+        # Songs most like one that's already in the index
+        return self.query_entry(self.signatures[song_id], self.histograms[song_id], k, song_id, exhaustive)
+
+    def save(self, path):
+        # Header with the parameters and song ids, then every signature and every histogram back to back
+        song_ids = list(self.signatures)
+        header = {'num_perm': self.num_perm, 'bands': self.bands, 'seed': self.seed, 'song_ids': song_ids}
+        signatures = array('Q')
+        histograms = array('d')
+        for song_id in song_ids:
+            signatures += self.signatures[song_id]
+            histograms += self.histograms[song_id]
+        write_file_atomically(path, [pack_header(INDEX_MAGIC, INDEX_FORMAT_VERSION, header), signatures.tobytes(),
+                                     histograms.tobytes()])
+
+    @classmethod
+    def load(cls, path):
+        NOTES_IN_OCTAVE = 12
+        with open(path, 'rb') as f:
+            header = read_header(f, INDEX_MAGIC, INDEX_FORMAT_VERSION, 'similarity index')
+            song_ids = header['song_ids']
+            signatures = array('Q')
+            signatures.fromfile(f, len(song_ids) * header['num_perm'])
+            histograms = array('d')
+            histograms.fromfile(f, len(song_ids) * NOTES_IN_OCTAVE)
+
+        index = cls(header['num_perm'], header['bands'], header['seed'])
+        for i, song_id in enumerate(song_ids):
+            index.add_entry(song_id, signatures[i * index.num_perm:(i + 1) * index.num_perm],
+                            histograms[i * NOTES_IN_OCTAVE:(i + 1) * NOTES_IN_OCTAVE])
+        return index
+
+
+def build_index(paths, index=None, max_workers=None, chunksize=8, cache_dir=None):
+    # Fingerprints and signatures are computed across processes, only the bucket inserts happen here.
+    # Pass an existing index to add to it, files already in it are skipped.
+    if index is None:
+        index = SimilarityIndex()
+    paths = [path for path in paths if path not in index]
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+
+    get_entry = partial(get_file_entry, num_perm=index.num_perm, seed=index.seed, cache_dir=cache_dir)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for entry in executor.map(get_entry, paths, chunksize=chunksize):
+            if entry is not None:
+                index.add_entry(*entry)
+    return index
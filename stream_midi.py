@@ -0,0 +1,337 @@
+import asyncio
+import heapq
+import mmap
+import os
+import struct
+from operator import itemgetter
+
+from parse_midi import (DEFAULT_TEMPO, Note, NotePairer, TempoMap, TrackParser, check_header, get_track_chunks,
+                        iter_stream_track, label_chroma, make_chroma, parse_chord, parse_header_data, read_exactly)
+
+LIVE_FRAME_HEADER = struct.Struct('<dB')  # Seconds as a double, then the length of the message that follows
+MICROSECONDS_PER_SECOND = 1000000
+
+
+def label_track_events(track_events, track_id):
+    for tick, event in track_events:
+        yield tick, track_id, event
+
+
+def iter_file_events(path):
+    # Every track gets its own lazy parser over the same mmap, so merging them costs nothing up front
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as midi_data:
+            _, num_track_chunks, _ = parse_header_data(midi_data)
+            track_iterators = [label_track_events(TrackParser(midi_data, start, end, i).iter_events(), i)
+                               for i, (start, end) in enumerate(get_track_chunks(midi_data, num_track_chunks))]
+            yield from heapq.merge(*track_iterators, key=itemgetter(0))
+
+
+def iter_stream_tracks(midi_file, num_track_chunks, merge=True):
+    # Tracks in a stream come one after another, so merging means holding on to every track but the last.
+    # Format 0 files (and merge=False) stream with flat memory.
+    earlier_tracks = []
+    for i in range(num_track_chunks):
+        chunk_header = read_exactly(midi_file, 8)
+        if chunk_header[0:4] != b'MTrk':
+            raise ValueError('Invalid Track header')
+        track_events = label_track_events(
+            iter_stream_track(midi_file, int.from_bytes(chunk_header[4:8], "big"), i), i)
+
+        if not merge:
+            yield from track_events
+        elif i == num_track_chunks - 1:
+            yield from heapq.merge(*earlier_tracks, track_events, key=itemgetter(0))
+        else:
+            earlier_tracks.append(list(track_events))
+
+
+def iter_path_tracks(path, merge=True):
+    with open(path, 'rb') as f:
+        _, num_track_chunks, _ = parse_header_data(read_exactly(f, 14))
+        yield from iter_stream_tracks(f, num_track_chunks, merge)
+
+
+def read_events(path_or_stream, merge=True):
+    # Returns (division, events) where events lazily yields (absolute tick, track id, event) in tick order,
+    # ties in track order. Only the header has been read when this returns.
+    if isinstance(path_or_stream, (str, bytes, os.PathLike)):
+        with open(path_or_stream, 'rb') as f:
+            midi_format, _, division = parse_header_data(read_exactly(f, 14))
+        check_header(midi_format, division)
+        if merge:
+            return division, iter_file_events(path_or_stream)
+        return division, iter_path_tracks(path_or_stream, merge)
+
+    midi_format, num_track_chunks, division = parse_header_data(read_exactly(path_or_stream, 14))
+    check_header(midi_format, division)
+    return division, iter_stream_tracks(path_or_stream, num_track_chunks, merge)
+
+
+def iter_events(path_or_stream, merge=True):
+    _, events = read_events(path_or_stream, merge)
+    yield from events
+
+
+class NoteTracker:
+    # Incremental note pairing over a (tick, track id, event) stream, shared by the generator stages
+    def __init__(self, division, note_policy='fifo'):
+        self.note_pairer = NotePairer(note_policy)
+        self.tempo_map = TempoMap(division)
+        self.track_ends = {}
+        self.length = 0
+
+    def add_event(self, tick, track_id, event):
+        # Returns the note this event released, if any
+        self.track_ends[track_id] = tick
+        self.length = tick
+        status = event.command[0]
+        cmd_nib = status >> 4
+        if status == 0xFF and event.data[0] == 0x51:
+            self.tempo_map.add_tempo(tick, int.from_bytes(event.payload[0:3], "big"))
+        if cmd_nib != 0x8 and cmd_nib != 0x9:
+            return None
+
+        channel = status & 0x0F
+        key = event.data[0]
+        vel = event.data[1]
+        if cmd_nib == 0x9 and vel != 0:
+            self.note_pairer.note_on(Note(tick, channel, key, vel, self.tempo_map.tick_to_seconds(tick)), track_id)
+            return None
+
+        note = self.note_pairer.note_off(channel, key)
+        if note is not None:
+            note.end_tick = tick
+            note.end_time = self.tempo_map.tick_to_seconds(tick)
+        return note
+
+    def close_all(self):
+        return self.note_pairer.close_all(self.track_ends, self.tempo_map)
+
+
+def iter_notes(events, division, note_policy='fifo'):
+    # Generator stage: yields each Note as soon as it is released, then whatever is still sounding at the end
+    note_tracker = NoteTracker(division, note_policy)
+    for tick, track_id, event in events:
+        note = note_tracker.add_event(tick, track_id, event)
+        if note is not None:
+            yield note
+    yield from note_tracker.close_all()
+
+
+def iter_chord_labels(events, division, beat_size=None, note_policy='fifo', max_delay=0):
+    # Generator stage: yields (beat tick, notes, chord label) for each beat as soon as the stream has moved past it.
+    # Notes still held at that point count as ending at the beat edge, like LiveChordTracker windows, so a drone
+    # or pedal note never holds up output. With max_delay (ticks) a beat waits up to that long for its held notes
+    # to be released first, and beats whose notes all end in time get the same labels as Song.get_chord_labels.
+    # Only notes that can still reach a future beat are kept around.
+    if beat_size is None:
+        beat_size = division
+
+    note_tracker = NoteTracker(division, note_policy)
+    closed_notes = []
+    beat_tick = 0
+
+    def label_beat(current_tick, held_notes=()):
+        beat_end = current_tick + beat_size
+        notes = sorted([n for n in closed_notes if n.end_tick > current_tick and n.start_tick <= beat_end - 1] +
+                       list(held_notes), key=lambda n: n.start_tick)
+        actual_notes = [n for n in sorted(notes, key=lambda x: x.key) if n.channel != 0x9]
+        return current_tick, notes, parse_chord(actual_notes)
+
+    for tick, track_id, event in events:
+        # Everything before this tick has been seen, so every beat ending by now can be labeled
+        while beat_tick + beat_size <= tick:
+            beat_end = beat_tick + beat_size
+            held_notes = [SoundingNote(n, beat_end) for n in note_tracker.note_pairer.iter_sounding()
+                          if n.start_tick <= beat_end - 1]
+            if held_notes and tick < beat_end + max_delay:
+                break
+            yield label_beat(beat_tick, held_notes)
+            beat_tick += beat_size
+            closed_notes = [n for n in closed_notes if n.end_tick > beat_tick]
+
+        note = note_tracker.add_event(tick, track_id, event)
+        if note is not None:
+            closed_notes.append(note)
+
+    closed_notes += note_tracker.close_all()
+    while beat_tick < note_tracker.length + beat_size:
+        yield label_beat(beat_tick)
+        beat_tick += beat_size
+        closed_notes = [n for n in closed_notes if n.end_tick > beat_tick]
+
+
+class SoundingNote:
+    # Stand-in for a note that's still held when its window closes, ending at the window edge
+    __slots__ = ['start_tick', 'end_tick', 'channel', 'key', 'velocity']
+
+    def __init__(self, note, end_tick):
+        self.start_tick = note.start_tick
+        self.end_tick = end_tick
+        self.channel = note.channel
+        self.key = note.key
+        self.velocity = note.velocity
+
+
+class LiveChordTracker:
+    # Chord labels for live input, one window at a time. Timestamps are integers in any unit (ticks for files,
+    # microseconds for live input) with window_size in the same unit. A window is labeled as soon as a message
+    # or advance() shows time has moved past it, weighing each note by how much of it falls inside the window,
+    # so held notes count without waiting for their release. Adding a message is O(1) apart from the windows it
+    # closes, and each of those only looks at the notes that touched it.
+    def __init__(self, window_size=DEFAULT_TEMPO, note_policy='fifo', start=0):
+        self.window_size = window_size
+        self.window_start = start
+        self.note_pairer = NotePairer(note_policy)
+        self.released_notes = []  # Notes released inside the current window
+        self.running_status = -1
+        self.timestamp = start
+
+    def close_window(self):
+        window_end = self.window_start + self.window_size
+        sounding = list(self.note_pairer.iter_sounding())
+        chroma = make_chroma(self.released_notes + [SoundingNote(note, window_end) for note in sounding],
+                             self.window_size, 1, self.window_start)
+        notes = sorted(self.released_notes + sounding, key=lambda n: n.start_tick)
+        label = self.window_start, notes, label_chroma(chroma)[0]
+
+        # Notes are only ever released into the window that's open at the time, so none of these reach the next one
+        self.released_notes = []
+        self.window_start = window_end
+        return label
+
+    def close_windows(self, timestamp):
+        # Closes every window ending at or before timestamp, returning (window start, notes, label) for each.
+        # Doesn't move the message timestamp, so this can run off a clock that's ahead of late messages.
+        labels = []
+        while timestamp >= self.window_start + self.window_size:
+            labels.append(self.close_window())
+        return labels
+
+    def advance(self, timestamp):
+        if timestamp < self.timestamp:
+            raise ValueError(f'Timestamp {timestamp} is before the previous message at {self.timestamp}')
+        self.timestamp = timestamp
+        return self.close_windows(timestamp)
+
+    def release(self, note, timestamp):
+        note.end_tick = timestamp
+        self.released_notes.append(note)
+
+    def add_message(self, timestamp, message):
+        # One raw MIDI message, status byte first or data bytes only under running status
+        labels = self.advance(timestamp)
+        # A message stamped inside a window that close_windows already labeled counts from the open one
+        timestamp = max(timestamp, self.window_start)
+        status = message[0]
+        data = message[1:]
+        if status < 0x80:
+            if self.running_status == -1:
+                raise ValueError('Data bytes without a running status')
+            status = self.running_status
+            data = message
+        elif status < 0xF0:
+            self.running_status = status
+        elif status < 0xF8:
+            # System common messages cancel running status, real-time ones leave it alone
+            self.running_status = -1
+
+        cmd_nib = status >> 4
+        channel = status & 0x0F
+        if cmd_nib == 0x9 and data[1] != 0:
+            self.note_pairer.note_on(Note(timestamp, channel, data[0], data[1]), 0)
+        elif cmd_nib == 0x8 or cmd_nib == 0x9:
+            note = self.note_pairer.note_off(channel, data[0])
+            if note is not None:
+                self.release(note, timestamp)
+        elif cmd_nib == 0xB and (data[0] == 120 or data[0] == 123):
+            # All Sound Off / All Notes Off
+            for note in self.note_pairer.release_channel(channel):
+                self.release(note, timestamp)
+        return labels
+
+    def flush(self):
+        # End of input: release whatever is still held and label the window that's open
+        for channel in range(16):
+            for note in self.note_pairer.release_channel(channel):
+                self.release(note, max(self.timestamp, self.window_start))
+        return self.advance(self.timestamp) + [self.close_window()]
+
+
+def iter_file_messages(path):
+    # (seconds, raw message) for every channel message of a file in playback order, a stand-in for a live port
+    division, events = read_events(path)
+    tempo_map = TempoMap(division)
+    for tick, _, event in events:
+        status = event.command[0]
+        if status == 0xFF and event.data[0] == 0x51:
+            tempo_map.add_tempo(tick, int.from_bytes(event.payload[0:3], "big"))
+        elif status < 0xF0:
+            yield tempo_map.tick_to_seconds(tick), bytes(event.command + event.data)
+
+
+def encode_live_message(seconds, message):
+    return LIVE_FRAME_HEADER.pack(seconds, len(message)) + message
+
+
+async def replay_file(path, writer, speed=1.0, realtime=True):
+    # Plays a file's channel messages into a stream as live frames, paced in real time unless realtime is off
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    for seconds, message in iter_file_messages(path):
+        if realtime:
+            delay = start + seconds / speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        writer.write(encode_live_message(seconds, message))
+        await writer.drain()
+    writer.close()
+    await writer.wait_closed()
+
+
+async def iter_live_chord_labels(reader, window_size=DEFAULT_TEMPO, note_policy='fifo', idle_timeout=None):
+    # Async generator over live frames from a stream, yielding (window start, notes, label) with times in
+    # microseconds. With idle_timeout (seconds), windows also close on the clock while no input arrives.
+    loop = asyncio.get_running_loop()
+    tracker = LiveChordTracker(window_size, note_policy)
+    clock_offset = None
+    while True:
+        try:
+            if idle_timeout is None or clock_offset is None:
+                header = await reader.readexactly(LIVE_FRAME_HEADER.size)
+            else:
+                header = await asyncio.wait_for(reader.readexactly(LIVE_FRAME_HEADER.size), idle_timeout)
+        except asyncio.TimeoutError:
+            # readexactly only consumes once everything it asked for is there, so nothing is lost here.
+            # The clock only closes windows, frames that turn up late after this still get added.
+            now = round((loop.time() + clock_offset) * MICROSECONDS_PER_SECOND)
+            for label in tracker.close_windows(now):
+                yield label
+            continue
+        except asyncio.IncompleteReadError as e:
+            if e.partial:
+                raise ValueError('Live stream ended partway through a message')
+            break
+
+        seconds, length = LIVE_FRAME_HEADER.unpack(header)
+        message = await reader.readexactly(length)
+        if clock_offset is None:
+            clock_offset = seconds - loop.time()
+        for label in tracker.add_message(round(seconds * MICROSECONDS_PER_SECOND), message):
+            yield label
+
+    for label in tracker.flush():
+        yield label
+
+
+async def serve_live_chords(socket_path, on_label, window_size=DEFAULT_TEMPO, note_policy='fifo', idle_timeout=None):
+    # Unix socket server, every connection is its own live stream and on_label(label) gets called per window
+    async def handle_connection(reader, writer):
+        try:
+            async for label in iter_live_chord_labels(reader, window_size, note_policy, idle_timeout):
+                on_label(label)
+        finally:
+            writer.close()
+
+    return await asyncio.start_unix_server(handle_connection, socket_path)
@@ -0,0 +1,112 @@
+SMALL_VARIABLE_TIMES = [bytes([value]) for value in range(0x80)]
+CHANNEL_DATA_LENGTHS = [0 if status >= 0xF0 else 1 if status >> 4 in (0xC, 0xD) else 2 for status in range(256)]
+
+
+def encode_variable_time(value):
+    if value < 0x80:
+        return SMALL_VARIABLE_TIMES[value]
+    encoded = bytearray([value & 0x7F])
+    value >>= 7
+    while value:
+        encoded.append((value & 0x7F) | 0x80)
+        value >>= 7
+    encoded.reverse()
+    return bytes(encoded)
+
+
+def encode_variable_times(values):
+    # Nearly every delta fits in one byte, those come straight out of the table
+    small = SMALL_VARIABLE_TIMES
+    return [small[value] if value < 0x80 else encode_variable_time(value) for value in values]
+
+
+def encode_header(midi_format, num_track_chunks, division):
+    return (b'MThd' + (6).to_bytes(4, "big") + midi_format.to_bytes(2, "big") + num_track_chunks.to_bytes(2, "big") +
+            division.to_bytes(2, "big"))
+
+
+def encode_track(deltas, statuses, datas, use_running_status=True):
+    # One MTrk chunk from parallel delta time, status and data sequences, data laid out as in TrackEvent.data.
+    # Everything goes into a single buffer sized for the worst case (4 byte delta + status + data per event),
+    # the chunk length is patched in at the end and the unused tail cut off.
+    # With use_running_status a channel status is left out when it repeats the previous one. Meta and sysex events
+    # always carry their status and cancel running status, as the spec requires.
+    variable_times = encode_variable_times(deltas)
+    buffer = bytearray(8 + 5 * len(statuses) + sum(len(data) for data in datas))
+    buffer[0:4] = b'MTrk'
+    offset = 8
+    running_status = -1
+    for variable_time, status, data in zip(variable_times, statuses, datas):
+        end = offset + len(variable_time)
+        buffer[offset:end] = variable_time
+        offset = end
+        if status != running_status or not use_running_status:
+            buffer[offset] = status
+            offset += 1
+        running_status = status if status < 0xF0 else -1
+        end = offset + len(data)
+        buffer[offset:end] = data
+        offset = end
+
+    buffer[4:8] = (offset - 8).to_bytes(4, "big")
+    del buffer[offset:]
+    return buffer
+
+
+def encode_track_events(events, use_running_status=True):
+    return encode_track([event.tick for event in events], [event.command[0] for event in events],
+                        [event.data for event in events], use_running_status)
+
+
+def encode_tracks(midi_format, division, tracks, use_running_status=True):
+    return encode_header(midi_format, len(tracks), division) + b''.join(
+        encode_track_events(track.events, use_running_status) for track in tracks)
+
+
+def encode_event_store(midi_format, division, event_store, use_running_status=True):
+    # Straight from the columns, no TrackEvents. The store is sorted by tick but stably, so taking each track's
+    # events in store order gives back the order they had in the file.
+    track_indices = [[] for _ in range(event_store.num_tracks)]
+    for i, track_id in enumerate(event_store.track_ids):
+        track_indices[track_id].append(i)
+
+    deltas = event_store.deltas
+    statuses = event_store.statuses
+    data1 = event_store.data1
+    data2 = event_store.data2
+    meta_data = event_store.meta_data
+    chunks = [encode_header(midi_format, event_store.num_tracks, division)]
+    for indices in track_indices:
+        datas = []
+        for i in indices:
+            status = statuses[i]
+            data_length = CHANNEL_DATA_LENGTHS[status]
+            if data_length == 2:
+                datas.append(bytes((data1[i], data2[i])))
+            elif data_length == 1:
+                datas.append(SMALL_VARIABLE_TIMES[data1[i]])
+            else:
+                start, _, end = event_store.get_meta_span(i)
+                datas.append(meta_data[start:end])
+        chunks.append(encode_track([deltas[i] for i in indices], [statuses[i] for i in indices], datas,
+                                   use_running_status))
+    return b''.join(chunks)
+
+
+def encode_song(song, midi_format=None, use_running_status=True):
+    # A Song doesn't remember its header format, by default one track means format 0 and more means format 1
+    if song.event_store is not None:
+        num_tracks = song.event_store.num_tracks
+    else:
+        num_tracks = len(song.tracks)
+    if midi_format is None:
+        midi_format = 0 if num_tracks == 1 else 1
+
+    if song.event_store is not None:
+        return encode_event_store(midi_format, song.division, song.event_store, use_running_status)
+    return encode_tracks(midi_format, song.division, song.tracks, use_running_status)
+
+
+def write_song(song, path, midi_format=None, use_running_status=True):
+    with open(path, 'wb') as f:
+        f.write(encode_song(song, midi_format, use_running_status))